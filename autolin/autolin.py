@@ -0,0 +1,163 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shlex
+import taxoniumtools
+import phenotypes
+import propose_sublineages
+import convert_autolinpb_totax
+import clade_counts
+import taxonium_tree
+
+'''
+Run the autolin workflow (phenotype weights -> propose_sublineages.py -> convert_autolinpb_totax.py) as one command:
+python3 autolin.py run -i {MAT} -w {work directory} ...
+Each stage records a content hash of its input files, its parameters and the source of its script and the modules it imports
+(including taxoniumtools) in the work directory, and stages whose hash is unchanged (and whose outputs still exist) are skipped on the next run.
+The parsed protobuf is kept in memory and shared by all stages; the proposal stage only loads it again with bte for -o or --gtf.
+'''
+
+def argparser():
+    parser = argparse.ArgumentParser(description="Run the autolin workflow with cached stages.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="Run phenotype weighting (optional), lineage proposal and Taxonium conversion, skipping stages whose inputs are unchanged.")
+    run.add_argument("-i", "--input", required=True, help="Path to the protobuf to annotate.")
+    run.add_argument("-w", "--workdir", default="autolin_run", help="Directory for the outputs and the stage cache. Default autolin_run")
+    run.add_argument("-m", "--metadata", default=None, help="Path to a tab separated metadata file (sample IDs first, optionally gzipped), used for weighting and included in the Taxonium output.")
+    run.add_argument("-c", "--column-name", nargs="+", default=None, help="Metadata column(s) to weight samples by, as in phenotypes.py. If not given, samples are not weighted.")
+    run.add_argument("-s", "--scheme", choices=list(phenotypes.WEIGHT_SCHEMES.keys()), default="ordinal", help="Weighting scheme, as in phenotypes.py. Default ordinal")
+    run.add_argument("--categories", default=None, help="Path to the ordinal categories file, as in phenotypes.py.")
+    run.add_argument("--default-weight", type=float, default=0.5, help="Weight of samples without a usable value, as in phenotypes.py. Default 0.5")
+    run.add_argument("--combine-method", choices=list(phenotypes.COMBINE_METHODS.keys()), default="mean", help="How to combine the weights of several columns. Default mean")
+    run.add_argument("--propose-args", default="", help='Additional arguments for propose_sublineages.py, as one quoted string (e.g. --propose-args="-r -m 5").')
+    run.add_argument("-mc", "--metadata_columns", default=None, help="Comma separated metadata columns to include in the Taxonium output. Default: all columns.")
+    run.add_argument("--inner_join", action="store_true", help="Only keep samples with metadata in the Taxonium metadata table.")
+    run.add_argument("--memory_budget", type=float, default=1024, help="Memory budget (MB) for the metadata join. Default 1024")
+    run.add_argument("-f", "--force", action="store_true", help="Rerun every stage, ignoring the cache.")
+    return parser
+
+def file_digest(path, known):
+    """Hash a file's content. Digests are remembered by path, size and modification time, so unchanged files are not read again."""
+    st = os.stat(path)
+    key = "{}:{}:{}".format(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    if key not in known:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        known[key] = h.hexdigest()
+    return known[key]
+
+def source_files(*modules):
+    """List the source files of modules, so a stage's hash changes with the code it runs. A package contributes all of its .py files."""
+    files = []
+    for module in modules:
+        if hasattr(module, "__path__"):
+            for path in module.__path__:
+                files.extend(sorted(glob.glob(os.path.join(path, "**", "*.py"), recursive=True)))
+        else:
+            files.append(module.__file__)
+    return files
+
+def stage_hash(params, files, known):
+    h = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    for path in files:
+        h.update(file_digest(path, known).encode())
+    return h.hexdigest()
+
+class Pipeline:
+    def __init__(self, workdir, force):
+        self.workdir = workdir
+        self.force = force
+        self.cache_file = os.path.join(workdir, "autolin.cache.json")
+        os.makedirs(workdir, exist_ok=True)
+        self.cache = {"files": {}, "stages": {}}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file, 'r') as f:
+                self.cache = json.load(f)
+
+    def save(self):
+        with open(self.cache_file, 'w') as f:
+            json.dump(self.cache, f, indent=1)
+
+    def stage(self, name, params, inputs, outputs, func):
+        """Run func unless the stage's inputs, parameters and script are unchanged since its last run and its outputs exist. Returns whether it ran."""
+        h = stage_hash(params, inputs, self.cache["files"])
+        if not self.force and self.cache["stages"].get(name) == h and all([os.path.exists(o) for o in outputs]):
+            print("{}: up to date, skipping.".format(name))
+            return False
+        print("{}: running.".format(name))
+        func()
+        self.cache["stages"][name] = h
+        self.save()
+        return True
+
+def run(args):
+    pipeline = Pipeline(args.workdir, args.force)
+    base = os.path.join(args.workdir, os.path.basename(args.input).replace(".gz", "").replace(".pb", ""))
+    tree_data = []
+    def get_tree_data():
+        #the protobuf is parsed at most once per run, and only if a stage needs it.
+        if len(tree_data) == 0:
+            tree_data.append(convert_autolinpb_totax.read_pb(args.input))
+        return tree_data[0]
+
+    weights_file = None
+    if args.column_name != None:
+        if args.metadata == None:
+            print("ERROR: weighting by --column-name requires --metadata.")
+            exit(1)
+        prefix = os.path.join(args.workdir, "pheno")
+        weights_file = prefix + ".weights.tsv"
+        categories = phenotypes.read_categories(args.categories) if args.categories != None else phenotypes.TB_CATEGORIES
+        #the categories are read here, so their content (not only --categories) is part of the stage's parameters.
+        columns = [phenotypes.parse_column(spec, args.scheme, categories) for spec in args.column_name]
+        def weigh():
+            samples = phenotypes.get_samples(args.input, get_tree_data())
+            meta = phenotypes.get_metadata(samples, args.metadata, [column for column, _, _ in columns])
+            column_weights, weights = phenotypes.compute_weights(meta, columns, args.default_weight, args.combine_method)
+            phenotypes.write_outputs(prefix + ".tsv", meta, columns, column_weights, weights, prefix)
+        params = {"columns": columns, "default_weight": args.default_weight, "combine_method": args.combine_method}
+        inputs = [args.input, args.metadata] + source_files(phenotypes, taxoniumtools) + ([args.categories] if args.categories != None else [])
+        pipeline.stage("weights", params, inputs, [weights_file], weigh)
+
+    delta_file = base + ".delta.tsv"
+    proposals_file = base + ".proposals.tsv"
+    labels_file = base + ".labels.tsv"
+    propose_argv = ["-i", args.input, "-x", delta_file, "-d", proposals_file, "-l", labels_file] + shlex.split(args.propose_args)
+    if weights_file != None:
+        propose_argv += ["-p", weights_file]
+    def propose():
+        propose_args = propose_sublineages.argparser().parse_args(propose_argv)
+        #saving a protobuf (-o) and translation (--gtf) need bte's tree; otherwise the parsed protobuf is reused.
+        t = taxonium_tree.TaxoniumTree.from_protobuf(get_tree_data()) if propose_args.output == None and propose_args.gtf == None else None
+        propose_sublineages.propose(propose_args, t)
+    #the weights file is hashed by content, so re-weighting that gives the same weights does not rerun the proposal.
+    inputs = [args.input] + source_files(propose_sublineages, taxonium_tree, clade_counts, taxoniumtools) + ([weights_file] if weights_file != None else [])
+    pipeline.stage("propose", {"argv": propose_argv[8:]}, inputs, [delta_file, proposals_file, labels_file], propose)
+
+    output_file = base + ".autolin.jsonl.gz"
+    counts_file = base + ".autolin.cladecounts.tsv"
+    convert_argv = ["-a", args.input, "-d", delta_file, "-o", output_file, "-cc", counts_file, "--memory_budget", str(args.memory_budget)]
+    if args.metadata != None:
+        convert_argv += ["-amd", args.metadata]
+        if args.metadata_columns != None:
+            convert_argv += ["-mc", args.metadata_columns]
+        if args.inner_join:
+            convert_argv += ["--inner_join"]
+    def convert():
+        convert_autolinpb_totax.convert(convert_autolinpb_totax.parse_args(convert_argv), get_tree_data())
+    inputs = [args.input, delta_file] + source_files(convert_autolinpb_totax, clade_counts, taxoniumtools) + ([args.metadata] if args.metadata != None else [])
+    pipeline.stage("convert", {"argv": convert_argv[8:]}, inputs, [output_file, counts_file], convert)
+    print("Outputs are in {}: proposals {}, labels {}, Taxonium tree {}, clade counts {}.".format(args.workdir, proposals_file, labels_file, output_file, counts_file))
+
+def main():
+    parser = argparser()
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+
+if __name__ == "__main__":
+    main()
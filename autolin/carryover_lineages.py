@@ -0,0 +1,152 @@
+import argparse
+import hashlib
+import heapq
+import itertools
+from propose_sublineages import load_tree
+
+'''
+Carry lineages over from one tree release to the next.
+Node IDs change between UShER releases, so each lineage in the old tree is matched to the node of the new tree whose samples best match its own.
+Each lineage is fingerprinted by a bottom-k MinHash sketch of its sample set; only the new-tree ancestors of its sketch samples are candidates,
+so matching takes roughly (number of lineages) x k x (tree depth) time rather than comparing every lineage with every node.
+'''
+
+def hash_sample(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'big')
+
+def sketch_lineages(t, lineages, k):
+    """Return a bottom-k MinHash sketch (the k samples with the smallest hashes) and the sample count of each lineage.
+
+    Sketches are built bottom-up in one postorder pass, each node's by merging its children's sketches, so the cost is the sum over
+    nodes of min(k, samples below the node) rather than the sum of every lineage's size.
+    """
+    lineage_nodes = {}
+    for lin, nid in lineages.items():
+        lineage_nodes.setdefault(nid, []).append(lin)
+    sketches = {}
+    below = {}
+    for node in reversed(t.depth_first_expansion()):
+        if node.is_leaf():
+            sketch, size = [(hash_sample(node.id), node.id)], 1
+        else:
+            children = [below.pop(c.id) for c in node.children]
+            #children's sketches are sorted, so the merge only reads as far as the k smallest.
+            sketch = list(itertools.islice(heapq.merge(*[csketch for csketch, _ in children]), k))
+            size = sum([csize for _, csize in children])
+        for lin in lineage_nodes.get(node.id, []):
+            sketches[lin] = ([l for _, l in sketch], size)
+        below[node.id] = (sketch, size)
+    return sketches
+
+def get_leaf_counts(t):
+    """Count the leaves below every node of the tree in one postorder pass."""
+    counts = {}
+    for node in reversed(t.depth_first_expansion()):
+        if node.is_leaf():
+            counts[node.id] = 1
+        else:
+            counts[node.id] = sum([counts[c.id] for c in node.children])
+    return counts
+
+def match_lineage(t, sketch, size, leaf_counts):
+    """Find the node of the new tree which best matches a lineage's sample set.
+
+    Every ancestor of a sketch sample in the new tree is a candidate. The share of the sketch below a candidate estimates the share of the
+    lineage below it, which with the candidate's exact leaf count gives an estimated Jaccard similarity between the two sample sets.
+    Ties go to the smaller (deeper) node. Returns (jaccard, node id), or (0, None) if no sketch sample is in the new tree.
+    """
+    hits = {}
+    present = 0
+    for sample in sketch:
+        try:
+            node = t.get_node(sample)
+        except Exception:
+            node = None
+        if node == None:
+            continue
+        present += 1
+        while node != None:
+            hits[node.id] = hits.get(node.id, 0) + 1
+            node = node.parent
+    if present == 0:
+        return (0, None)
+    #samples missing from the new tree don't count towards the lineage's size there.
+    lineage_size = size * present / len(sketch)
+    best = (0, None)
+    for nid, h in hits.items():
+        intersection = min(lineage_size * h / present, leaf_counts[nid])
+        jaccard = intersection / (lineage_size + leaf_counts[nid] - intersection)
+        if jaccard > best[0] or (jaccard == best[0] and best[1] != None and leaf_counts[nid] < leaf_counts[best[1]]):
+            best = (jaccard, nid)
+    return best
+
+def argparser():
+    parser = argparse.ArgumentParser(description="Carry lineages from an old tree over to a new tree release by matching their sample sets.")
+    parser.add_argument("-i", "--old", required=True, help='Path to the annotated old tree (protobuf or Taxonium jsonl).')
+    parser.add_argument("-n", "--new", required=True, help='Path to the new tree (protobuf).')
+    parser.add_argument("-o", "--output", required=True, help='Path to write the matched lineages as a lineage and node ID table, as used by matUtils annotate -f.')
+    parser.add_argument("-x", "--delta", help='Path to also write the matched lineages as a node ID and lineage table, in the propose_sublineages.py --delta format used by convert_autolinpb_totax.py -d.',default=None)
+    parser.add_argument("-q", "--quality", help='Path to write the match quality of every lineage (old and new node, old and new size, estimated Jaccard similarity).',default=None)
+    parser.add_argument("-k", "--sketch-size", help='Number of samples in each lineage\'s MinHash sketch. Lineages with at most this many samples are matched exactly. Default 256', type=int, default=256)
+    parser.add_argument("-j", "--min-jaccard", help='Minimum estimated Jaccard similarity to carry a lineage over. Default 0.5', type=float, default=0.5)
+    parser.add_argument("--all", action='store_true', help='Carry over all lineages, not only those proposed by autolin (auto.*).')
+    parser.add_argument("-v","--verbose",help='Print status updates.',action='store_true')
+    return parser
+
+def carryover(args):
+    if args.new.endswith(".jsonl") or args.new.endswith(".jsonl.gz"):
+        #internal nodes of a jsonl tree are named after their jsonl IDs, which matUtils annotate and the new pb do not know.
+        print("ERROR: The new tree (-n) must be a protobuf, so that the matched node IDs can be used with matUtils annotate or convert_autolinpb_totax.py -d.")
+        exit(1)
+    old = load_tree(args.old)
+    try:
+        annotes = old.dump_annotations()
+    except:
+        annotes = old.get_annotations() #replacement function in newer versions of bte
+    if not args.all:
+        annotes = {k:v for k,v in annotes.items() if k[:5] == 'auto.'}
+    if args.verbose:
+        print("Sketching {} lineages from {}.".format(len(annotes), args.old))
+    sketches = sketch_lineages(old, annotes, args.sketch_size)
+    del old
+    new = load_tree(args.new)
+    leaf_counts = get_leaf_counts(new)
+    matched = {}
+    quality = []
+    for lin, nid in annotes.items():
+        sketch, size = sketches[lin]
+        jaccard, new_nid = match_lineage(new, sketch, size, leaf_counts)
+        if new_nid != None and jaccard >= args.min_jaccard:
+            matched[lin] = new_nid
+        else:
+            new_nid = None
+        quality.append((lin, nid, new_nid, size, leaf_counts[new_nid] if new_nid != None else 0, jaccard))
+    print("Carried over {} of {} lineages (minimum estimated Jaccard similarity {}).".format(len(matched), len(annotes), args.min_jaccard))
+    with open(args.output,'w+') as f:
+        for lin, nid in matched.items():
+            print("{}\t{}".format(lin, nid),file=f)
+    if args.delta != None:
+        #the delta format holds one lineage per node; where several lineages match the same node the outermost
+        #(the one with the most samples in the old tree) is kept.
+        nodes = {}
+        for lin, nid in sorted(matched.items(), key=lambda x: -sketches[x[0]][1]):
+            if nid not in nodes:
+                nodes[nid] = lin
+            elif args.verbose:
+                print("Lineages {} and {} both match node {}; keeping {} in {}.".format(nodes[nid], lin, nid, nodes[nid], args.delta))
+        with open(args.delta,'w+') as f:
+            for nid, lin in nodes.items():
+                print("{}\t{}".format(nid, lin),file=f)
+    if args.quality != None:
+        with open(args.quality,'w+') as f:
+            print("lineage\told_nid\tnew_nid\told_size\tnew_size\tjaccard",file=f)
+            for lin, nid, new_nid, old_size, new_size, jaccard in quality:
+                print("{}\t{}\t{}\t{}\t{}\t{:.4f}".format(lin, nid, new_nid if new_nid != None else "NA", old_size, new_size, jaccard),file=f)
+
+def main():
+    parser = argparser()
+    args = parser.parse_args()
+    carryover(args)
+
+if __name__ == "__main__":
+    main()
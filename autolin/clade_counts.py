@@ -0,0 +1,36 @@
+'''
+Inclusive and exclusive sample counts of each lineage, as matUtils summary -c writes them,
+computed in one postorder pass over a tree already in memory.
+Shared by propose_sublineages.py --cladecounts and convert_autolinpb_totax.py --cladecounts.
+'''
+
+def get_clade_counts(preorder):
+    """
+    Count the samples in each lineage (inclusive) and those not in any of its sublineages (exclusive).
+    preorder is a list of (node key, child keys, annotations, number of samples at the node) in preorder, where keys are
+    any hashable node identifiers. Sublineages are counted per annotation slot, as matUtils does.
+    """
+    slots = max([len(annotations) for _, _, annotations, _ in preorder] + [1])
+    counts = {}
+    below = {}
+    for node, children, annotations, samples in reversed(preorder):
+        total = samples
+        unclaimed = [samples] * slots
+        for child in children:
+            ctotal, cunclaimed = below.pop(child)
+            total += ctotal
+            for index in range(slots):
+                unclaimed[index] += cunclaimed[index]
+        for index, annotation in enumerate(annotations):
+            if annotation != "":
+                counts[annotation] = (total, unclaimed[index])
+                unclaimed[index] = 0
+        below[node] = (total, unclaimed)
+    return counts
+
+def write_clade_counts(counts_file, counts):
+    #same layout as matUtils summary -c
+    with open(counts_file, 'w') as f:
+        f.write("clade\tinclusive_count\texclusive_count\n")
+        for clade in sorted(counts.keys()):
+            f.write(f"{clade}\t{counts[clade][0]}\t{counts[clade][1]}\n")
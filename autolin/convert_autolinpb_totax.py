@@ -1,166 +1,320 @@
-import cmd
-import subprocess
 import argparse
 import os 
 import sys
 import gzip
+import tempfile
+import zlib
+from taxoniumtools import parsimony_pb2
+from taxoniumtools.ushertools import ArrayTree
+from taxoniumtools.usher_to_taxonium import do_processing
+from clade_counts import get_clade_counts, write_clade_counts
 
 '''
 next iteration of this will likely be a snakemake workflow
 '''
 '''
-This currently assumes that the user can run matUtils and usher_to_taxonium 
-'''
-
-'''
-sequence of commands:
-run autolin to get autolin.pb (make user do this currently)
-run matUtils extract -i autolin.pb -C autolin_clade.pb -o autolin_clade.tsv (make user do this currently)
-either rename first column to strain and optionally rename other columns 
-or join autolin_clade.tsv with metadata file to get metadata file with autolin annotations
-run usher_to_taxonium with --clade_types to convert autolin.pb to taxonium json
+sequence of steps (all in process, with no matUtils, shell commands or temporary files):
+run autolin to get autolin.pb (or the original pb and a --delta) (make user do this currently)
+read the clade of every sample from the pb, as matUtils summary -C would
+optionally join the sample clades with a metadata file
+run usher_to_taxonium's do_processing with --clade_types to convert autolin.pb to taxonium json
 
 #make an effort to separate script for sc2 and everything else at some point 
 '''
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Convert an AutoLIN protobuf file to a Taxonium JSON file.")
     parser.add_argument("--autolin_pb_path", "-a", type=str, required=True, help="Path to the input AutoLIN protobuf file.")
     #prob dont need this anymore, unless original Sc2 tree is used
     parser.add_argument("--sars-cov-2", "-sc2", action="store_true", help="Flag indicating if the data is SARS-CoV-2. Special \
         options must be handled for SC2")
     parser.add_argument("--additional_meta_data", "-amd", type=str, required=False, help="Path to tab separated metadata file, if additional metadata is desired. Sample ID column MUST be first.")
+    parser.add_argument("--metadata_columns", "-mc", type=str, required=False, help="Comma separated names of the -amd columns to include. Default: all columns.")
+    parser.add_argument("--inner_join", action="store_true", help="Only keep samples that have a row in the -amd metadata. By default samples without metadata are kept with empty values.")
+    parser.add_argument("--memory_budget", type=float, default=1024, help="Approximate memory (MB) the metadata join may use for its hash table. Larger joins are partitioned on disk. Default 1024")
+    parser.add_argument("--output", "-o", type=str, required=False, help="Path to the output jsonl.gz. Default: named after the input protobuf (or the delta file with -d).")
+    parser.add_argument("--cladecounts", "-cc", type=str, required=False, help="Path to write the inclusive and exclusive sample counts of each lineage, as matUtils summary -c would.")
+    parser.add_argument("--delta", "-d", type=str, required=False, help="Path to an annotation delta written by propose_sublineages.py --delta. If used, -a is the protobuf autolin was run on \
+        and the delta is applied to it in memory. Output is named after the delta file.")
     #save this for later. make sure alex is changing the name of the column in taxonium
     #parser.add_argument("--rename_annotation_column", "-o", type=str, required=False, help="Path to the output Taxonium JSON file. If not provided, \
     #    the output will be saved in the same directory as the input AutoLIN protobuf file with a .jsonl.gz extension.")
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+def read_delta(delta_file):
+    """
+    Read an annotation delta written by propose_sublineages.py --delta (or --partial).
 
-def get_annotations(autolin_pb_path, parent_dir):
+    Returns whether preexisting annotations were cleared and a dictionary of node ID to annotations.
     """
-    Convert an AutoLIN protobuf file to a Taxonium JSON file.
+    clear = False
+    delta = {}
+    with open(delta_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line == "":
+                continue
+            if line == "#clear":
+                clear = True
+                continue
+            if line[0] == "#":
+                #level markers from propose_sublineages.py --partial
+                continue
+            parts = line.split('\t')
+            delta[parts[0]] = parts[1:]
+    return clear, delta
+
+def read_pb(pb_path):
+    data = parsimony_pb2.data()
+    if is_gzipped(pb_path):
+        with gzip.open(pb_path, 'rb') as f:
+            data.ParseFromString(f.read())
+    else:
+        with open(pb_path, 'rb') as f:
+            data.ParseFromString(f.read())
+    return data
+
+def apply_delta(autolin_pb_path, delta_file=None, data=None):
+    """
+    Read the clade annotations of a protobuf, applying an annotation delta in memory if one is given
+    (instead of loading a protobuf re-saved by autolin).
 
     Parameters:
-    autolin_pb_path (str): Path to the input AutoLIN protobuf file.
-    taxonium_json_path (str): Path to the output Taxonium JSON file.
+    autolin_pb_path (str): Path to the autolin protobuf, or the protobuf autolin was run on if delta_file is given.
+    delta_file (str): Path to the annotation delta, or None.
+    data (parsimony_pb2.data): The already parsed protobuf, if it is in memory. It is updated in place.
+
+    Returns the (updated) tree data, a dictionary of sample to annotations (the same assignment as matUtils summary -C)
+    and a dictionary of lineage to inclusive and exclusive sample counts (as matUtils summary -c).
     """
-    
-    command = ["matUtils", "summary",
-               "-i", autolin_pb_path,
-               "-C", "./autolin_clade.tsv",
-               ]
-    #print(command)
-    try:
-        subprocess.run(command, check=True)
-    except Exception as e:
-        print(f"matUtils command ({' '.join(command)}) failed: {e}", file=sys.stderr)
-        sys.exit(1)
+    clear, delta = read_delta(delta_file) if delta_file != None else (False, {})
+    if data == None:
+        data = read_pb(autolin_pb_path)
+    if len(data.metadata) == 0:
+        #unannotated trees may not store metadata at all.
+        for _ in range(len(data.node_mutations)):
+            data.metadata.add()
+    condensed = {c.node_name: list(c.condensed_leaves) for c in data.condensed_nodes}
+    #read_newick names internal nodes node_1, node_2, ... in preorder, as bte and UShER do, and node numbers are the
+    #indices of node_mutations and metadata.
+    tree = ArrayTree()
+    for _ in tree.read_newick(data.newick, name_internal_nodes=True, branch_lengths=False):
+        pass
+    sample_clades = {}
+    found = 0
+    preorder = []
+    current = [None] * len(tree)
+    for i in range(len(tree)):
+        nid = tree.label[i]
+        leaf = tree.is_leaf(i)
+        clade_annotations = data.metadata[i].clade_annotations
+        if clear:
+            del clade_annotations[:]
+        if nid in delta:
+            del clade_annotations[:]
+            clade_annotations.extend(delta[nid])
+            found += 1
+        preorder.append((i, list(tree.children(i)), list(clade_annotations), len(condensed.get(nid, [nid])) if leaf else 0))
+        current[i] = list(current[tree.parent[i]]) if tree.parent[i] >= 0 else []
+        for index, annotation in enumerate(clade_annotations):
+            if index >= len(current[i]):
+                current[i].append("")
+            if annotation != "":
+                current[i][index] = annotation
+        if leaf:
+            for sample in condensed.get(nid, [nid]):
+                sample_clades[sample] = current[i]
+    if found != len(delta):
+        print(f"Warning: {len(delta) - found} nodes in {delta_file} were not found in {autolin_pb_path}.", file=sys.stderr)
+    return data, sample_clades, get_clade_counts(preorder)
+
+def clade_table(sample_clades):
+    """
+    Lay out the sample clades as matUtils summary -C does, with the sample column renamed to strain for usher_to_taxonium.
+    Returns the header, a generator of the rows (so the table is never copied into memory) and its estimated text size.
+    """
+    slots = max([len(v) for v in sample_clades.values()] + [1])
+    header = ["strain"] + ["annotation_" + str(i+1) for i in range(slots)]
+    size = sum([len(sample) + 1 + sum([max(len(a), 4) + 1 for a in annotations]) + 5 * (slots - len(annotations)) for sample, annotations in sample_clades.items()])
+    return header, clade_rows(sample_clades, slots), size
+
+def clade_rows(sample_clades, slots):
+    for sample, annotations in sample_clades.items():
+        annotations = [a if a != "" else "None" for a in annotations]
+        annotations += ["None"] * (slots - len(annotations))
+        yield [sample] + annotations
 
-def fix_metadata(clade_file):
-    #rename first column to strain
-    command = "sed -i '1s/^[^ \t]*/strain/' "+clade_file
-    subprocess.run(command, shell=True, check=True)
+def write_rows(f, rows):
+    for row in rows:
+        f.write("\t".join(row) + "\n")
 
-def usher_to_taxonium(autolin_pb_path, clade_file, sc2, columns):
-    #this is a crude version that doesnt have any option for column name changing 
-    #next iteration will need to read column names so im not hardcoding them 
-    #will deal with this in next iteration
-    print('clade file', clade_file)
+def to_taxonium(tree_source, output_path, sc2, header, clade_types, table):
+    #same conversion as usher_to_taxonium, but run in process on the already written metadata table
     if sc2:
-        #command= ["usher_to_taxonium","-i", autolin_pb_path, "--clade_types", "nextclade,pango", "-m", clade_file, "-c", "strain,annotation_1,annotation_2", "-o", autolin_pb_path.replace(".pb", ".jsonl.gz")]
+        #--clade_types nextclade,pango -c strain,annotation_1,annotation_2
         print("Currently, SARS-CoV-2 is unsupported. Check back in later releases. Exiting.", file=sys.stderr)
         sys.exit(1)
-
-    command= ["usher_to_taxonium","-i", autolin_pb_path, "--clade_types", "pango", "-m", "phenometa.tsv", "-c", ",".join(columns), "-o", autolin_pb_path.replace(".pb", ".jsonl.gz")]
-    #print(command)
-    subprocess.run(command, check=True)
+    do_processing(tree_source, output_path, metadata_file=table, columns=",".join(header), clade_types=",".join(clade_types))
 
 def is_gzipped(filepath):
     with open(filepath, 'rb') as f:
         return f.read(2) == b'\x1f\x8b'
 
-#one avenue to handle this. 
-#i think i prefer a join command 
-#need to figure out what docker supports for gzip
-'''
-def read_metadata(file, clade_file):
-    header = file.readline().strip()
-    print(header)
-    assert '\t' in header, f"Error: metadata is not tab-separated."
-    print('metadata is tab separated')
-    header.append
-    
-
-
-def merge_meta(amd, clade_file):
-    print('HERE')
-    if is_gzipped(amd):
-        with gzip.open(amd, 'rt') as f:
-            read_metadata(f, clade_file)
-    else:
-        with open(amd, 'r') as f:
-            read_metadata(f, clade_file)
-'''
+def open_table(path):
+    if is_gzipped(path):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
 
-#THIS CODE BLOCK IS NOT FINAL
-#MIXING PYTHON AND BASH IS NOT PREFERRED
-#WILL UPDATE SOON
-#note these commands use bash specific syntax
-#this may not work in all environments
-#i think this is ok for now since taxonium and usher_to_taxonium are also bash
-#need to check with docker container
-#all of this will likely be refactored into a snakemake workflow later
-def merge_meta(amd, clade_file):
-    with open(clade_file, 'r') as f:
-        header = f.readline().strip().split('\t')
-    #this ensures that all files have one annotation per node.
-    #maybe change later if there is a need 
-    assert len(header) == 2, f"Error: {clade_file} does not have exactly 2 columns."
-    if is_gzipped(amd):
-        cmd1 = f"echo \"$(head -n1 {clade_file})\\t$(zcat {amd} | head -n1 | cut -f2-)\" > phenometa.tsv"
-        cmd2 = f"join -t $'\\t' <(tail -n +2 {clade_file} | sort -k1,1) <(zcat {amd} | tail -n +2 | sort -k1,1) >> phenometa.tsv"
+def read_meta_rows(f, indices):
+    """Stream the rows of a metadata table, keeping the sample ID and the selected columns."""
+    for line in f:
+        parts = line.rstrip('\n').split('\t')
+        yield parts[0], [parts[i] if i < len(parts) else "" for i in indices]
+
+def hash_join(rows, meta_rows, width, left_join, build_meta, out):
+    """
+    Join clade rows (sample ID first) with (sample ID, values) metadata rows through a hash table on one side, streaming the other,
+    and write the joined rows to out as they are produced.
+    Returns the number of clade rows, the number of those without metadata and the number of metadata rows not in the tree.
+    Duplicate metadata rows for a sample are ignored after the first.
+    """
+    total = 0
+    missing = 0
+    unused = 0
+    if build_meta:
+        meta = {}
+        #extra rows per duplicated sample, so unused counts rows as the streamed side does.
+        duplicates = {}
+        for key, values in meta_rows:
+            if key not in meta:
+                meta[key] = values
+            else:
+                duplicates[key] = duplicates.get(key, 0) + 1
+        found = set()
+        for row in rows:
+            total += 1
+            values = meta.get(row[0])
+            if values == None:
+                missing += 1
+                if left_join:
+                    out.write("\t".join(row + [""] * width) + "\n")
+            else:
+                found.add(row[0])
+                out.write("\t".join(row + values) + "\n")
+        unused = sum(1 + duplicates.get(key, 0) for key in meta if key not in found)
     else:
-        cmd1 = f"echo \"$(head -n1 {clade_file})\\t$(head -n1 {amd} | cut -f2-)\" > phenometa.tsv"
-        cmd2 = f"join -t $'\\t' <(tail -n +2 {clade_file} | sort -k1,1) <(tail -n +2 {amd} | sort -k1,1) >> phenometa.tsv"
-    subprocess.run(cmd1, shell=True, check=True)
-    subprocess.run(cmd2, shell=True, check=True, executable="/bin/bash")
-    with open('phenometa.tsv', 'r') as f:
-        columns = f.readline().strip().split('\t')
-    return columns
-
-#this currently assumes that there is only 1 annotation within the mat
-#it will break if there are more than 1
-def main(): 
-    args = parse_args()
+        clades = {row[0]: row for row in rows}
+        total = len(clades)
+        found = set()
+        for key, values in meta_rows:
+            row = clades.get(key)
+            if row == None:
+                unused += 1
+            elif key not in found:
+                found.add(key)
+                out.write("\t".join(row + values) + "\n")
+        missing = total - len(found)
+        if left_join:
+            write_rows(out, [row + [""] * width for key, row in clades.items() if key not in found])
+    return total, missing, unused
+
+def partitioned_join(rows, meta_rows, width, left_join, partitions, out):
+    """Hash-partition both sides into temporary files, then join each partition in memory, writing its rows to out."""
+    total = 0
+    missing = 0
+    unused = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = [(os.path.join(tmpdir, f"clades.{i}.tsv"), os.path.join(tmpdir, f"meta.{i}.tsv")) for i in range(partitions)]
+        outs = [(open(cp, 'w'), open(mp, 'w')) for cp, mp in paths]
+        for row in rows:
+            outs[zlib.crc32(row[0].encode()) % partitions][0].write("\t".join(row) + "\n")
+        for key, values in meta_rows:
+            outs[zlib.crc32(key.encode()) % partitions][1].write("\t".join([key] + values) + "\n")
+        for cf, mf in outs:
+            cf.close()
+            mf.close()
+        for cp, mp in paths:
+            with open(cp, 'r') as cf, open(mp, 'r') as mf:
+                part_total, part_missing, part_unused = hash_join((line.rstrip('\n').split('\t') for line in cf), read_meta_rows(mf, range(1, width + 1)), width, left_join, False, out)
+            total += part_total
+            missing += part_missing
+            unused += part_unused
+    return total, missing, unused
+
+def merge_meta(amd, header, rows, clade_size, out, columns=None, left_join=True, memory_budget=1024):
+    """
+    Join the clade table (its header, rows and estimated text size) with a tab separated metadata file (sample ID first,
+    optionally gzipped), writing the joined table to out. Returns the joined header.
+    The smaller side (by estimated size) is held in a hash table and the other is streamed through it. If that side is larger
+    than memory_budget MB, both are partitioned on disk by sample ID and joined one partition at a time.
+    Rows are written in the order they are joined (partition by partition, in the order of the streamed side, with unmatched
+    tree samples after the matched ones when the tree side is held), not sorted; usher_to_taxonium looks them up by sample ID.
+    """
+    with open_table(amd) as f:
+        meta_header = f.readline().rstrip('\n').split('\t')
+        if columns == None:
+            indices = list(range(1, len(meta_header)))
+        else:
+            for c in columns:
+                if c not in meta_header[1:]:
+                    print(f"Error: column {c} was not found in {amd}.", file=sys.stderr)
+                    sys.exit(1)
+            indices = [meta_header.index(c) for c in columns]
+        width = len(indices)
+        header = header + [meta_header[i] for i in indices]
+        out.write("\t".join(header) + "\n")
+        #estimated text size of the metadata side; gzipped text is usually around a quarter of its uncompressed size.
+        meta_size = os.path.getsize(amd) * (4 if is_gzipped(amd) else 1) * (width + 1) / len(meta_header)
+        build_meta = meta_size < clade_size
+        #python strings and lists take several times the size of the text they hold.
+        build_size = 5 * (meta_size if build_meta else clade_size)
+        budget = max(memory_budget * 1024 * 1024, 1)
+        if build_size > budget:
+            #each partition keeps two files open while splitting.
+            partitions = min(int(build_size // budget) + 1, 256)
+            print(f"Joining metadata in {partitions} on-disk partitions.")
+            total, missing, unused = partitioned_join(rows, read_meta_rows(f, indices), width, left_join, partitions, out)
+        else:
+            total, missing, unused = hash_join(rows, read_meta_rows(f, indices), width, left_join, build_meta, out)
+    print(f"Joined metadata for {total - missing} of {total} samples; {missing} samples have no metadata" + (" (kept)" if left_join else " (dropped)") + f", {unused} metadata rows are for samples not in the tree.")
+    return header
+
+def convert(args, data=None):
+    """Run the conversion for parsed arguments. data is the already parsed -a protobuf, if it is in memory."""
     autolin_pb_path = args.autolin_pb_path
     amd = None
     if args.additional_meta_data:
         amd = args.additional_meta_data
-    #make sure directory handling is consistent between scripts
-    parent_dir = os.path.dirname(os.path.abspath(autolin_pb_path))
     sc2 = args.sars_cov_2
-    #print(parent_dir)
     print(autolin_pb_path)
-    get_annotations(autolin_pb_path, parent_dir)
-    #make sure autolin_clade.tsv is not empty
-    clade_file = None
-
-    with open(parent_dir+"/autolin_clade.tsv", 'r') as f:
-        if sum(1 for _ in f) == 1:
-            print(f"Error: {parent_dir}/autolin_clade.tsv was not created or is empty.", file=sys.stderr)
-            sys.exit(1)        
+    tree_data, sample_clades, clade_counts = apply_delta(autolin_pb_path, args.delta, data)
+    if args.cladecounts:
+        write_clade_counts(args.cladecounts, clade_counts)
+    if len(sample_clades) == 0:
+        print(f"Error: no samples were found in {autolin_pb_path}.", file=sys.stderr)
+        sys.exit(1)
+    header, rows, clade_size = clade_table(sample_clades)
+    #the first annotation of each node is shown as pango, as before; further annotation levels keep their column names.
+    clade_types = ["pango"] + header[2:]
+    #the table is written to a temporary file rather than held in memory, and read back by usher_to_taxonium.
+    with tempfile.TemporaryFile('w+') as table:
+        if amd != None:
+            columns = args.metadata_columns.split(",") if args.metadata_columns else None
+            header = merge_meta(amd, header, rows, clade_size, table, columns, not args.inner_join, args.memory_budget)
         else:
-            clade_file = parent_dir+"/autolin_clade.tsv"
-            print('clade', clade_file)
-            fix_metadata(clade_file)
-            if amd != None:
-                columns = merge_meta(amd, clade_file)
-            else:
-                subprocess.run(f"mv {clade_file} phenometa.tsv", shell=True, check=True)
-                with open('phenometa.tsv', 'r') as f:
-                    header = f.readline().strip().split('\t')
-                    assert len(header) == 2, f"Error: {clade_file} does not have exactly 2 columns."
-                    columns = header
-                    #columns = f.readline().strip().split('\t')
-    usher_to_taxonium(autolin_pb_path, clade_file, sc2, columns)
+            table.write("\t".join(header) + "\n")
+            write_rows(table, rows)
+        table.seek(0)
+        if args.delta:
+            #the annotations were applied in memory, so convert the parsed, updated tree rather than the file
+            output = args.output if args.output else os.path.splitext(args.delta)[0] + ".jsonl.gz"
+            to_taxonium(tree_data, output, sc2, header, clade_types, table)
+        else:
+            output = args.output if args.output else autolin_pb_path.replace(".pb", ".jsonl.gz")
+            to_taxonium(autolin_pb_path, output, sc2, header, clade_types, table)
+
+def main():
+    args = parse_args()
+    convert(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
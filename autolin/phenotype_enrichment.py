@@ -0,0 +1,185 @@
+import argparse
+import gzip
+import numpy as np
+from taxoniumtools import parsimony_pb2
+from taxoniumtools.ushertools import ArrayTree
+from phenotypes import get_metadata, is_gzipped
+
+'''
+Find the clades enriched for a phenotype (e.g. MDR-TB).
+Phenotype category counts are kept in one nodes x categories numpy array and summed up the tree one level at a time,
+so every internal node's counts, fractions and enrichment over the whole tree are available at once.
+'''
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compute phenotype category counts and enrichment for every clade of a tree.")
+    parser.add_argument(
+        "--metadata_file",
+        '-m',
+        type=str,
+        required=True,
+        help="Path to the input metadata file (tab-delimited with a header line, sample IDs in the first column).",
+    )
+    parser.add_argument(
+        "--mat",
+        "-t",
+        type=str,
+        required=True,
+        help="Path to the input mutation annotated tree",
+    )
+    parser.add_argument(
+        "--column-name",
+        "-c",
+        type=str,
+        required=True,
+        help="Name of the phenotype column. NOTE: Must exactly match the header name in the metadata file.",
+    )
+    parser.add_argument(
+        "--category",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only report these categories. The first is the one used for --weights. Default: all categories in the column.",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=1,
+        help="Only report clades with at least this many samples with a phenotype. Default 1",
+    )
+    parser.add_argument(
+        "--weights",
+        type=str,
+        default=None,
+        help="Path to write sample weights for propose_sublineages.py -p: the largest fraction of the first --category among the sample's clades of at least --min-size.",
+    )
+    parser.add_argument(
+        "--output_file",
+        '-o',
+        type=str,
+        required=True,
+        help="Path to the output node table.",
+    )
+    return parser.parse_args()
+
+def read_tree(tree):
+    """
+    Read a protobuf MAT into taxoniumtools' array tree, without building node objects.
+    Nodes are numbered in preorder, and internal nodes are named node_1, node_2, ... in preorder, as in bte and matUtils.
+    Returns the parent array, the node names and a dictionary of leaf to its (uncondensed) samples.
+    """
+    data = parsimony_pb2.data()
+    opener = gzip.open if is_gzipped(tree) else open
+    with opener(tree, 'rb') as f:
+        data.ParseFromString(f.read())
+    condensed = {c.node_name: list(c.condensed_leaves) for c in data.condensed_nodes}
+    t = ArrayTree()
+    for _ in t.read_newick(data.newick, name_internal_nodes=True, branch_lengths=False):
+        pass
+    leaf_samples = {node: condensed.get(t.label[node], [t.label[node]]) for node in range(len(t)) if t.is_leaf(node)}
+    return np.array(t.parent, dtype=np.int64), t.label, leaf_samples
+
+def depth_levels(parents):
+    """
+    Group the nodes by depth, root first, so each level's values can be passed to or from their parents in one vectorised step.
+    Depths are found by pointer doubling (every node jumps to its ancestor's ancestor each round), in log2(tree depth) rounds.
+    """
+    root = int(np.flatnonzero(parents < 0)[0])
+    ancestor = np.where(parents < 0, root, parents)
+    depth = (parents >= 0).astype(np.int64)
+    while (ancestor != root).any():
+        depth += depth[ancestor]
+        ancestor = ancestor[ancestor]
+    order = np.argsort(depth, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(depth))[:-1])
+
+def count_categories(parents, leaf_samples, meta, categories):
+    """Sum the category counts of every node's samples into a nodes x categories array, one tree level at a time from the leaves up."""
+    index = {c: i for i, c in enumerate(categories)}
+    nodes = []
+    found = []
+    for node, samples in leaf_samples.items():
+        for s in samples:
+            value = meta.get(s)
+            if value != None and value[0] in index:
+                nodes.append(node)
+                found.append(index[value[0]])
+    counts = np.zeros((len(parents), len(categories)), dtype=np.int64)
+    np.add.at(counts, (np.array(nodes, dtype=np.int64), np.array(found, dtype=np.int64)), 1)
+    for level in reversed(depth_levels(parents)[1:]):
+        np.add.at(counts, parents[level], counts[level])
+    return counts
+
+def write_node_table(output_file, parents, names, leaf_samples, counts, categories, report, min_size):
+    index = {c: i for i, c in enumerate(categories)}
+    columns = [index[c] for c in report]
+    #node 0 is the root, so its counts are the tree-wide totals.
+    expected = counts[0, columns] / counts[0].sum()
+    sizes = counts.sum(axis=1)
+    is_leaf = np.zeros(len(parents), dtype=bool)
+    is_leaf[list(leaf_samples.keys())] = True
+    kept = np.flatnonzero(~is_leaf & (sizes >= min_size) & (sizes > 0))
+    size = sizes[kept][:, None]
+    found = counts[kept][:, columns]
+    fraction = found / size
+    #z-score of the clade's count against a binomial draw of its size at the tree-wide frequency.
+    variance = size * expected * (1 - expected)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(variance > 0, (found - size * expected) / np.sqrt(variance), 0.0)
+        enrichment = fraction / expected
+    with open(output_file, 'w') as f:
+        header = ["node_id", "parent", "phenotyped_samples"]
+        for c in report:
+            header.extend([f"{c}_count", f"{c}_fraction", f"{c}_enrichment", f"{c}_z"])
+        f.write("\t".join(header) + "\n")
+        for row, node in enumerate(kept):
+            fields = [names[node], names[parents[node]] if parents[node] >= 0 else "", str(sizes[node])]
+            for i in range(len(columns)):
+                zscore = f"{z[row, i]:.4f}"
+                if zscore == "-0.0000":
+                    #a z-score that rounds to zero from below would otherwise print as -0.0000.
+                    zscore = "0.0000"
+                fields.extend([str(found[row, i]), f"{fraction[row, i]:.4f}", f"{enrichment[row, i]:.4f}" if expected[i] > 0 else "NA", zscore])
+            f.write("\t".join(fields) + "\n")
+
+def write_weights(weights_file, parents, leaf_samples, counts, categories, category, min_size):
+    """Weight each sample by the largest fraction of the category among its ancestral clades of at least min_size samples."""
+    i = categories.index(category)
+    sizes = counts.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where((sizes >= min_size) & (sizes > 0), counts[:, i] / sizes, 0.0)
+    #the best fraction on each node's path from the root, passed down one tree level at a time.
+    best = np.zeros(len(parents))
+    levels = depth_levels(parents)
+    best[levels[0]] = fraction[levels[0]]
+    for level in levels[1:]:
+        best[level] = np.maximum(best[parents[level]], fraction[level])
+    with open(weights_file, 'w') as f:
+        f.write("Sample\tWeight\n")
+        for node, samples in sorted(leaf_samples.items()):
+            inherited = best[parents[node]] if parents[node] >= 0 else 0.0
+            for s in samples:
+                f.write(f"{s}\t{inherited:.4f}\n")
+
+def main():
+    args = parse_args()
+    parents, names, leaf_samples = read_tree(args.mat)
+    samples = set()
+    for s in leaf_samples.values():
+        samples.update(s)
+    print(f"Read {len(parents)} nodes and {len(samples)} samples from the tree.")
+    meta = get_metadata(samples, args.metadata_file, [args.column_name])
+    categories = sorted(set([v[0] for v in meta.values() if v[0] != ""]))
+    report = args.category if args.category != None else categories
+    for c in report:
+        if c not in categories:
+            raise ValueError(f"Category '{c}' not found in column '{args.column_name}'.")
+    counts = count_categories(parents, leaf_samples, meta, categories)
+    write_node_table(args.output_file, parents, names, leaf_samples, counts, categories, report, args.min_size)
+    print(f"Clade counts and enrichment for {len(report)} categories written to {args.output_file}.")
+    if args.weights != None:
+        write_weights(args.weights, parents, leaf_samples, counts, categories, report[0], args.min_size)
+        print(f"Sample weights for {report[0]} written to {args.weights}.")
+
+if __name__ == "__main__":
+    main()
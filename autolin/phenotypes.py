@@ -1,7 +1,9 @@
-import os 
 import argparse
-import subprocess
 import gzip
+import math
+import numpy as np
+from taxoniumtools import parsimony_pb2
+from taxoniumtools.ushertools import ArrayTree
 
 '''
 '''
@@ -26,8 +28,36 @@ def parse_args():
         "--column-name",
         "-c",
         type=str,
+        nargs="+",
         required=True,
-        help="Name of the column to extract from the metadata file. NOTE: Must exactly match the header name in the metadata file.",
+        help="Name of the column(s) to extract from the metadata file, optionally as column:scheme, or column:ordinal:file to give an ordinal column its own categories file. All columns are read in one pass; with several columns each also gets its own weights file and their weights are combined with --combine-method. NOTE: Must exactly match the header name in the metadata file.",
+    )
+    parser.add_argument(
+        "--scheme",
+        "-s",
+        type=str,
+        choices=list(WEIGHT_SCHEMES.keys()),
+        default="ordinal",
+        help="How to turn the column into sample weights. ordinal: ranked categories given by --categories (default: TB resistance types), frequency: rarer values weigh more, numeric: values scaled to between 0 and 1. Default ordinal",
+    )
+    parser.add_argument(
+        "--categories",
+        type=str,
+        default=None,
+        help="Path to a file with one category per line, lowest to highest, for ordinal columns without their own categories file (column:ordinal:file).",
+    )
+    parser.add_argument(
+        "--default-weight",
+        type=float,
+        default=0.5,
+        help="Weight of samples whose value is missing, not a listed category (ordinal) or not a number (numeric). Default 0.5",
+    )
+    parser.add_argument(
+        "--combine-method",
+        type=str,
+        choices=list(COMBINE_METHODS.keys()),
+        default="mean",
+        help="How to combine the weights of several columns. Default mean",
     )
     '''
     parser.add_argument(
@@ -46,143 +76,173 @@ def parse_args():
     )
     return parser.parse_args()
 
-def get_samples(tree):
-    cmd = f"matUtils summary -i {tree} -s samples.subprocess"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"Command failed with error: {result.stderr}")
-    with open("samples.subprocess", 'r') as f:
-        samples = [line.strip().split()[0] for line in f if line.strip()]
-    os.remove("samples.subprocess")
+def is_gzipped(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+def get_samples(tree, data=None):
+    """
+    Read the sample names of a MAT straight from the protobuf into a set, expanding condensed nodes as matUtils does.
+    An already parsed protobuf can be passed as data to avoid reading the tree again.
+    """
+    if data == None:
+        data = parsimony_pb2.data()
+        opener = gzip.open if is_gzipped(tree) else open
+        with opener(tree, 'rb') as f:
+            data.ParseFromString(f.read())
+    condensed = {c.node_name: c.condensed_leaves for c in data.condensed_nodes}
+    t = ArrayTree()
+    for _ in t.read_newick(data.newick, branch_lengths=False):
+        pass
+    samples = set()
+    for node in t.leaves():
+        samples.update(condensed.get(t.label[node], [t.label[node]]))
     return samples
 
-#maybe this should be a join command? 
-#not sure 
-def read_meta(file, samples, column_name):
+def read_meta(file, samples, column_names):
+    """Stream the metadata once, keeping only the values of the given columns for rows whose sample is in the tree."""
     metadata = {}
-    headers = file.readline().strip().split('\t')
-    print(headers)
-    if column_name not in headers:
-        raise ValueError(f"Column '{column_name}' not found in metadata file headers.")
-    col_index = headers.index(column_name)
+    headers = file.readline().strip('\n').split('\t')
+    for column_name in column_names:
+        if column_name not in headers:
+            raise ValueError(f"Column '{column_name}' not found in metadata file headers.")
+    col_indices = [headers.index(column_name) for column_name in column_names]
+    rows = 0
+    duplicates = 0
     for line in file:
-        parts = line.strip('\n').split('\t')
+        rows += 1
+        parts = line.rstrip('\n').split('\t')
         sample_id = parts[0]
-        #print(sample_id)
         if sample_id in samples:
-            #i think a subdict it less useful
-            metadata[sample_id] = parts[col_index]
-            #metadata[sample_id] = {headers[col_index]: parts[col_index]}
-    #print(metadata)
+            if sample_id in metadata:
+                duplicates += 1
+            metadata[sample_id] = [parts[i] if i < len(parts) else "" for i in col_indices]
+    print(f"Read {rows} metadata rows: {len(metadata)} of {len(samples)} tree samples matched, {rows - len(metadata) - duplicates} rows not in the tree, {duplicates} duplicate rows (last kept).")
+    if len(metadata) < len(samples):
+        print(f"{len(samples) - len(metadata)} tree samples have no metadata.")
     return metadata
 
-def get_metadata(samples, metadata_file, column_name):
+def get_metadata(samples, metadata_file, column_names):
     if metadata_file.endswith(".gz"):
         with gzip.open(metadata_file, "rt") as gz:
-            metadata = read_meta(gz, samples, column_name)
+            metadata = read_meta(gz, samples, column_names)
     else:
         with open(metadata_file, 'r') as f:
-            metadata = read_meta(f, samples, column_name)
+            metadata = read_meta(f, samples, column_names)
     return metadata
 
-def frequency_based_weight(metadata, output):
-
-    counts = {}
-    for p in metadata.values():
-        if p in counts:
-            counts[p] += 1
-        else:
-            counts[p] = 1
-
-    total = sum(counts.values())
-
-    # Compute frequency-based weights (rarer = higher weight)
-    weights = {}
-    for sample, p in metadata.items():
-        freq = counts[p] / total
-        weights[sample] = 1 - freq
-    with open(output, 'w') as f:
-        f.write("Sample\tWeight\tPhenotype\n")
-        for sample in metadata:
-            f.write(f"{sample}\t{weights[sample]:.4f}\t{metadata[sample]}\n")
-            #f.write((f"{sample}\t{weights[sample]:.4f}\n"))
-
-#will change this to make it more general later 
-def ordinal_based_weight(metadata, output):
-    categories = ["Sensitive", "HR-TB", "RR-TB", "MDR-TB", "Pre-XDR-TB", "XDR-TB"]
+#default ordinal categories: TB resistance types, lowest to highest.
+TB_CATEGORIES = ["Sensitive", "HR-TB", "RR-TB", "MDR-TB", "Pre-XDR-TB", "XDR-TB"]
+
+def read_categories(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+#each scheme maps an array of a column's values to an array of weights. Values are reduced to their distinct values first,
+#so per-value work (lookups, parsing) is done once per distinct value and spread back over the column in one indexing step.
+def frequency_based_weight(values, categories, default):
+    """Rarer values get higher weights: 1 - the value's frequency."""
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return (1 - counts / len(values))[inverse]
+
+def ordinal_based_weight(values, categories, default):
+    """Ranked categories get equally spaced weights from 1/n (lowest) to 1 (highest); anything else gets the default."""
     n = len(categories)
-    weights = {cat: (i+1)/n for i, cat in enumerate(categories)}
-    
-
-    # Compute frequency-based weights (rarer = higher weight)
-    #for sample, p in metadata.items():
-    #    metadata[sample] = weights[p]
-    #    weights[sample] = 1 - freq
-    weight = 0.0
-    with open(output, 'w') as f:
-        f.write("Sample\tWeight\tPhenotype\n")
-        for sample in metadata:
-            if metadata[sample] not in weights:
-                weight = 0.5 #default weight if not in categories
-            else:
-                weight = weights[metadata[sample]]
-            f.write(f"{sample}\t{weight:.4f}\t{metadata[sample]}\n")
-            #f.write((f"{sample}\t{weights[sample]:.4f}\n"))
-
-def format_outputs(output_file):
-    cmd = f"cut -f1,3 {output_file} > pheno.pheno.tsv"
-    subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    cmd = f"cut -f1,2 {output_file} > pheno.weights.tsv"
-    subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    #this may cause local issues
-    #cmd = f"python3 propose_sublineages.py -i {args.mat} -p pheno.weights.tsv -o {args.mat.replace('.pb', '.pheno.autolin.pb')}"
-    #run these within convert ?
-    #cmd = f"echo -e \"$(head -n1 autolin_clade.tsv)\t$(head -n1 pheno.pheno.tsv | cut -f2-)\" > phenometa.tsv"
-    #subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    #cmd = f"join -t $'\t'     <(tail -n +2 autolin_clade.tsv | sort -k1,1)     <(tail -n +2 pheno.pheno.tsv | sort -k1,1) >> phenometa.tsv"
-    #subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    table = {cat: (i+1)/n for i, cat in enumerate(categories)}
+    distinct, inverse = np.unique(values, return_inverse=True)
+    return np.array([table.get(v, default) for v in distinct.tolist()], dtype=float)[inverse]
+
+def parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+def numeric_based_weight(values, categories, default):
+    """Numbers are scaled linearly to between 0 (smallest) and 1 (largest); anything else gets the default."""
+    distinct, inverse = np.unique(values, return_inverse=True)
+    numbers = np.array([parse_number(v) for v in distinct.tolist()], dtype=float)[inverse]
+    present = ~np.isnan(numbers)
+    if not present.any():
+        return np.full(len(values), default)
+    low = numbers[present].min()
+    span = numbers[present].max() - low
+    scaled = (numbers - low) / span if span > 0 else np.ones(len(values))
+    return np.where(present, scaled, default)
+
+WEIGHT_SCHEMES = {
+    "frequency": frequency_based_weight,
+    "ordinal": ordinal_based_weight,
+    "numeric": numeric_based_weight,
+}
+
+#each takes a columns x samples array of weights.
+COMBINE_METHODS = {
+    "mean": lambda ws: ws.mean(axis=0),
+    "max": lambda ws: ws.max(axis=0),
+    "product": lambda ws: ws.prod(axis=0),
+}
+
+
+def parse_column(spec, default_scheme, default_categories):
+    """
+    Split a column[:scheme[:categories file]] argument into (column, scheme, categories).
+    The scheme defaults to --scheme, and the ordinal categories to --categories (or the TB resistance types).
+    """
+    parts = spec.split(":", 2)
+    if len(parts) == 1 or parts[1] not in WEIGHT_SCHEMES:
+        return spec, default_scheme, default_categories
+    categories = read_categories(parts[2]) if len(parts) == 3 else default_categories
+    return parts[0], parts[1], categories
+
+def compute_weights(meta, columns, default_weight, combine_method):
+    """Return the weights of each column and their combination, in the order of meta, as numpy arrays."""
+    #each scheme is computed in one pass over the whole column, then the columns are combined in one pass over all of them.
+    column_weights = []
+    for i, (column, scheme, categories) in enumerate(columns):
+        values = np.array([v[i] for v in meta.values()], dtype=str)
+        column_weights.append(WEIGHT_SCHEMES[scheme](values, categories, default_weight))
+    if len(column_weights) == 1:
+        return column_weights, column_weights[0]
+    return column_weights, COMBINE_METHODS[combine_method](np.stack(column_weights))
+
+def write_outputs(output_file, meta, columns, column_weights, weights, prefix="pheno"):
+    """
+    Write the Sample/Weight/Phenotype table, and the {prefix}.weights.tsv and {prefix}.pheno.tsv tables taken from it.
+    With several columns, the phenotype tables have one column per metadata column (named after it)
+    and each column's own weights are also written to {prefix}.{column}.weights.tsv.
+    """
+    names = [column for column, _, _ in columns]
+    header = "\t".join(names) if len(names) > 1 else "Phenotype"
+    with open(output_file, 'w') as out, open(f"{prefix}.weights.tsv", 'w') as wf, open(f"{prefix}.pheno.tsv", 'w') as pf:
+        out.write(f"Sample\tWeight\t{header}\n")
+        wf.write("Sample\tWeight\n")
+        pf.write(f"Sample\t{header}\n")
+        for (sample, values), weight in zip(meta.items(), weights):
+            row = "\t".join(values)
+            out.write(f"{sample}\t{weight:.4f}\t{row}\n")
+            wf.write(f"{sample}\t{weight:.4f}\n")
+            pf.write(f"{sample}\t{row}\n")
+    if len(names) > 1:
+        for column, cw in zip(names, column_weights):
+            with open(f"{prefix}.{column}.weights.tsv", 'w') as f:
+                f.write("Sample\tWeight\n")
+                for sample, weight in zip(meta.keys(), cw):
+                    f.write(f"{sample}\t{weight:.4f}\n")
 
 def main():
     args = parse_args()
     tree = args.mat
     samples = get_samples(tree)
     print(f"Extracted {len(samples)} samples from the tree.")
-    meta = get_metadata(samples, args.metadata_file, args.column_name)
-    print(len(meta))
-
-    #try frequency based 
-    #frequency_based_weight(meta, args.output_file)
-    #ordinal based
-    ordinal_based_weight(meta, args.output_file)
-    format_outputs(args.output_file)
-    print("Weights and phenotypes written to pheno.weights.tsv and pheno.pheno.tsv respectively.")
-    
-    '''
-    # Read metadata file
-    with open(args.metadata_file, 'r') as f:
-        metadata_lines = f.readlines()
-    
-    # Read mutation annotated tree file
-    with open(args.mat, 'r') as f:
-        mat_lines = f.readlines()
-    
-    # Process data (this is a placeholder for actual processing logic)
-    processed_data = []
-    for line in metadata_lines:
-        if line.strip():  # Skip empty lines
-            processed_data.append(line.strip())
-    
-    for line in mat_lines:
-        if line.strip():  # Skip empty lines
-            processed_data.append(line.strip())
-    
-    # Write to output file
-    with open(args.output_file, 'w') as f:
-        for item in processed_data:
-            f.write(f"{item}\n")
-    
-    print(f"Processed data written to {args.output_file}")
-    '''
+    categories = read_categories(args.categories) if args.categories != None else TB_CATEGORIES
+    columns = [parse_column(spec, args.scheme, categories) for spec in args.column_name]
+    meta = get_metadata(samples, args.metadata_file, [column for column, _, _ in columns])
+    column_weights, weights = compute_weights(meta, columns, args.default_weight, args.combine_method)
+    write_outputs(args.output_file, meta, columns, column_weights, weights)
+    print(f"Weights and phenotypes for {len(weights)} samples written to {args.output_file}, pheno.weights.tsv and pheno.pheno.tsv.")
+    if len(columns) > 1:
+        print("Weights for each column written to " + ", ".join([f"pheno.{column}.weights.tsv" for column, _, _ in columns]) + ".")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,21 @@
 import sys
 sys.path.append("~/bin:")
-import bte
+try:
+    import bte
+except ImportError:
+    #only needed for protobuf input; Taxonium jsonl input is read with taxonium_tree.
+    bte = None
 import sys
+import os
+import gzip
 import argparse
+import heapq
+import random
+import datetime
+from array import array
+import numpy as np
 from pango_aliasor.aliasor import Aliasor
+from clade_counts import get_clade_counts, write_clade_counts
 global_aliasor = Aliasor()
 
 def process_mstr(mstr):
@@ -115,6 +127,35 @@ def evaluate_candidate(a, nid, sum_and_counts, dist_to_root, minimum_size=0,mini
         candidate_value = node_count * candidate_to_parent / (mean_distances + candidate_to_parent)
     return candidate_value
 
+def new_score_surface():
+    """Columns of the --scores table, keyed by node ID; numeric columns are kept as arrays rather than one row object per node."""
+    return {"node_id": [], "parent": [], "parent_nid": [], "score": array('d'), "count": array('d'), "distinction": array('d'), "mean_distance": array('d'), "banned": array('b')}
+
+def add_score_surface(scores, ann, anid, candidates, sum_and_count, dist_to_root, minimum_size = 0, minimum_distinction = 0, banned = set()):
+    """Add the score of every internal node of lineage a, with the components it is computed from, to the --scores columns.
+
+    Components are the sample count, the distinction (distance from the lineage node) and the mean distance of samples below the node.
+    """
+    for c in candidates:
+        if c.is_leaf():
+            continue
+        node_sum, node_count = sum_and_count.get(c.id,[0,0])
+        mean_distances = node_sum/node_count if node_count > 0 else 0
+        cscore = evaluate_candidate(anid, c.id, sum_and_count, dist_to_root, minimum_size, minimum_distinction)
+        scores["node_id"].append(c.id)
+        scores["parent"].append(ann)
+        scores["parent_nid"].append(anid)
+        scores["score"].append(cscore)
+        scores["count"].append(node_count)
+        scores["distinction"].append(dist_to_root[c.id] - dist_to_root[anid])
+        scores["mean_distance"].append(mean_distances)
+        scores["banned"].append(int(c.id in banned))
+
+def write_score_surface(scores_file, scores):
+    #one compressed array per column, e.g. numpy.load(scores_file)["score"]
+    with open(scores_file,'wb') as f:
+        np.savez_compressed(f, **{column: np.array(values) for column, values in scores.items()})
+
 def evaluate_lineage(t, dist_to_root, anid, candidates, sum_and_count, minimum_size = 0, minimum_distinction = 0, banned = set()):
     """Evaluate every descendent branch of lineage a to propose new sublineages.
 
@@ -132,6 +173,166 @@ def evaluate_lineage(t, dist_to_root, anid, candidates, sum_and_count, minimum_s
         return (0,None)
     return max(good_candidates, key=lambda x: x[0])
 
+def search_lineage(t, dist_to_root, anid, rank, sum_and_count, minimum_size = 0, minimum_distinction = 0, banned = set(), recent_counts = None):
+    """Find the best descendent branch of lineage a with a top-down branch and bound search.
+
+    A candidate's score can't exceed its node count, and node counts only shrink moving down the tree,
+    so subtrees whose count is below the best score found so far, or at most the minimum size, are never visited.
+    Gives the same result as evaluate_lineage over the whole lineage.
+
+    Args:
+        t (MATree): The tree.
+        anid (str): The lineage annotation node to check.
+        rank (dict): Position of each node in the reverse breadth first expansion of the lineage, used to break ties as evaluate_lineage does.
+        recent_counts (dict): Optional number of recent descendent samples per node; subtrees without any are skipped.
+    """
+    best_score, best_node = 0, None
+    heap = [(-sum_and_count.get(anid,[0,0])[1], rank[anid], t.get_node(anid))]
+    while len(heap) > 0:
+        negcount, _, node = heapq.heappop(heap)
+        if -negcount <= minimum_size or -negcount < best_score:
+            #the largest remaining subtree can't hold a better candidate, so neither can any other.
+            break
+        if node.id not in banned and not node.is_leaf():
+            cscore = evaluate_candidate(anid, node.id, sum_and_count, dist_to_root, minimum_size, minimum_distinction)
+            if cscore > 0 and (cscore > best_score or (cscore == best_score and rank[node.id] < rank[best_node.id])):
+                best_score, best_node = cscore, node
+        for child in node.children:
+            if child.is_leaf():
+                continue
+            if recent_counts != None and recent_counts.get(child.id,0) == 0:
+                continue
+            ccount = sum_and_count.get(child.id,[0,0])[1]
+            if ccount > minimum_size and ccount >= best_score:
+                heapq.heappush(heap, (-ccount, rank[child.id], child))
+    return (best_score, best_node)
+
+def sample_leaves(rbfs, ignore, sample_size, rng):
+    """Draw a uniform subsample of the leaves of a lineage which are not yet labeled.
+
+    Returns the sampled leaves as a dictionary of id to node and the number of leaves they were drawn from.
+    """
+    eligible = [n for n in rbfs if n.is_leaf() and n.id not in ignore]
+    if len(eligible) <= sample_size:
+        sampled = eligible
+    else:
+        sampled = rng.sample(eligible, sample_size)
+    return {n.id:n for n in sampled}, len(eligible)
+
+def add_sampled_paths(anid, leaves, dist_to_root, path_sums, mutweights = {}, sampleweights = {}, sign = 1):
+    """Add (or remove, with sign = -1) the contribution of each sampled leaf to the unscaled sum and count of each of its ancestors up to the lineage node.
+
+    A leaf contributes its own weight plus its count times its parent's distance from the lineage root to every ancestor;
+    the ancestor's own distance is subtracted when the estimate is made, in estimate_sum_and_count.
+    """
+    for leaf in leaves:
+        if leaf.id == anid:
+            continue
+        if len(sampleweights) == 0:
+            count = 1
+        else:
+            count = float(sampleweights.get(leaf.id, 0))
+        if count == 0:
+            continue
+        value = compute_mutation_weight(leaf,mutweights) + count * dist_to_root[leaf.parent.id]
+        node = leaf.parent
+        while node != None:
+            psum, pcount = path_sums.get(node.id, (0,0))
+            path_sums[node.id] = (psum + sign * value, pcount + sign * count)
+            if node.id == anid:
+                break
+            node = node.parent
+
+def estimate_sum_and_count(t, anid, path_sums, scale, dist_to_root, mutweights = {}):
+    """Estimate get_sum_and_count values for every node on a sampled leaf path, scaling the sampled sums and counts up to all unlabeled leaves.
+    """
+    sum_and_count_dict = {}
+    for nid, (psum, pcount) in path_sums.items():
+        if pcount <= 0:
+            continue
+        if nid == anid:
+            above = -compute_mutation_weight(t.get_node(nid),mutweights)
+        else:
+            above = dist_to_root[t.get_node(nid).parent.id]
+        sum_and_count_dict[nid] = (scale * (psum - pcount * above), scale * pcount)
+    return sum_and_count_dict
+
+def lineage_leaf_table(t, anid, leaf_order, leaf_ranges, dist_to_root, ignore = set(), sampleweights = {}):
+    """Collect what exact sums and counts need from each leaf of lineage a, in preorder leaf order, as numpy arrays.
+
+    A leaf adds its count to every ancestor's count, and its own weight plus its count times its parent's distance from the lineage node
+    to every ancestor's sum, so any node's exact sum and count follow from prefix sums over its range of leaves (see exact_sum_and_count).
+    Leaves in ignore are masked out; label_leaves masks more as lineages are proposed.
+    """
+    start, end = leaf_ranges[anid]
+    table = {"start": start, "weight": np.zeros(end - start), "parent_distance": np.zeros(end - start), "count": np.zeros(end - start),
+             "parent_start": np.zeros(end - start, dtype=np.int64), "parent_end": np.ones(end - start, dtype=np.int64), "unlabeled": np.zeros(end - start, dtype=bool)}
+    for i, l in enumerate(leaf_order[start:end]):
+        if l == anid:
+            #a lineage on a single sample has no candidates.
+            continue
+        pid = t.get_node(l).parent.id
+        table["weight"][i] = dist_to_root[l] - dist_to_root[pid]
+        table["parent_distance"][i] = dist_to_root[pid]
+        table["count"][i] = 1 if len(sampleweights) == 0 else float(sampleweights.get(l, 0))
+        table["parent_start"][i], table["parent_end"][i] = leaf_ranges[pid][0] - start, leaf_ranges[pid][1] - start
+        table["unlabeled"][i] = l not in ignore
+    return table
+
+def label_leaves(table, leaf_ranges, nid):
+    """Mask the leaves of node nid out of a lineage_leaf_table, once they are labeled."""
+    start, end = leaf_ranges[nid]
+    table["unlabeled"][start - table["start"]:end - table["start"]] = False
+
+def exact_sum_and_count(t, anid, nids, table, leaf_ranges, dist_to_root):
+    """Compute the get_sum_and_count values of just the nodes nids of lineage a, from prefix sums over the lineage's unlabeled leaves.
+
+    As in get_sum_and_count, a leaf's own weight only reaches its ancestors if its parent has a positive count.
+    """
+    count = np.where(table["unlabeled"], table["count"], 0.0)
+    count_sums = np.concatenate(([0.0], np.cumsum(count)))
+    parent_counts = count_sums[table["parent_end"]] - count_sums[table["parent_start"]]
+    value = np.where(table["unlabeled"] & (parent_counts > 0), table["weight"], 0.0) + count * table["parent_distance"]
+    value_sums = np.concatenate(([0.0], np.cumsum(value)))
+    sum_and_count = {}
+    for nid in nids:
+        if nid == anid:
+            #never a candidate; its distinction from itself is 0.
+            continue
+        start, end = leaf_ranges[nid][0] - table["start"], leaf_ranges[nid][1] - table["start"]
+        node_count = count_sums[end] - count_sums[start]
+        if node_count > 0:
+            node_sum = value_sums[end] - value_sums[start] - node_count * dist_to_root[t.get_node(nid).parent.id]
+            sum_and_count[nid] = (float(node_sum), float(node_count))
+    return sum_and_count
+
+def screen_lineage(t, dist_to_root, anid, approx_sum_and_count, screen, table, leaf_ranges, minimum_size = 0, minimum_distinction = 0, banned = set(), recent_counts = None):
+    """Screen candidate branches with approximate sums and counts, then rescore only the top candidates exactly.
+
+    Args:
+        t (MATree): The tree.
+        anid (str): The lineage annotation node to check.
+        approx_sum_and_count (dict): Estimated sums and counts from estimate_sum_and_count.
+        screen (int): The number of top approximate candidates to rescore exactly.
+        table (dict): The lineage's lineage_leaf_table, with labeled leaves masked.
+
+    Returns the best exactly scored candidate as (score, node), whether it was also the top approximate candidate and the number of nodes rescored.
+    This only compares the screened candidates with each other; --validate-screen checks against a full exact search.
+    """
+    approximate = []
+    for nid in approx_sum_and_count.keys():
+        if nid in banned or (recent_counts != None and recent_counts.get(nid,0) == 0):
+            continue
+        cscore = evaluate_candidate(anid, nid, approx_sum_and_count, dist_to_root, minimum_size, minimum_distinction)
+        if cscore > 0:
+            approximate.append((cscore, nid))
+    if len(approximate) == 0:
+        return (0, None), True, 0
+    screened = [t.get_node(nid) for _, nid in heapq.nlargest(screen, approximate)]
+    sum_and_count = exact_sum_and_count(t, anid, [c.id for c in screened], table, leaf_ranges, dist_to_root)
+    best = evaluate_lineage(t, dist_to_root, anid, screened, sum_and_count, minimum_size, minimum_distinction, banned)
+    return best, best[1] == screened[0], len(screened)
+
 def get_skipset(t, annotes):
     """
     Return the set of nodes which are, or are ancestral to, existing lineages on the tree. 
@@ -201,6 +402,39 @@ def build_annotation_network(t, rawann):
                 annd[ann].append(p)
     return annd
 
+def build_lineage_index(annotes, ann_net):
+    """Index the lineages in annotes by parent lineage, so each lineage's child lineages can be found without scanning all annotations.
+    Proposals are added with add_to_lineage_index as they are made.
+    """
+    children = {}
+    for ann in annotes.keys():
+        for p in ann_net.get(ann, []):
+            add_to_lineage_index(children, p, ann)
+    return children
+
+def add_to_lineage_index(children, parent, ann):
+    if parent not in children:
+        children[parent] = [ann]
+    elif ann not in children[parent]:
+        children[parent].append(ann)
+
+def build_leaf_ranges(t):
+    """Order the leaves of the tree by preorder, and find the range of that order spanned by every node's descendent leaves.
+
+    Returns the ordered leaf IDs and a dictionary of node ID to (start, end), so a node's leaves are leaves[start:end] and number end - start.
+    """
+    order = t.depth_first_expansion()
+    leaves = []
+    ranges = {}
+    for node in order:
+        if node.is_leaf():
+            ranges[node.id] = (len(leaves), len(leaves) + 1)
+            leaves.append(node.id)
+    for node in reversed(order):
+        if not node.is_leaf():
+            ranges[node.id] = (ranges[node.children[0].id][0], ranges[node.children[-1].id][1])
+    return leaves, ranges
+
 def read_samples_weights(sfile):
     samples = {}
     with open(sfile) as inf:
@@ -212,14 +446,111 @@ def read_samples_weights(sfile):
                 samples[spent[0]] = spent[1]
     return samples
 
+def parse_date(date):
+    """Parse a YYYY-MM-DD date, or a partial YYYY-MM or YYYY date as the start of that period. Returns None if unparseable."""
+    for fmt in ("%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            return datetime.datetime.strptime(date, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+def read_recent_samples(metadata_file, date_column, days):
+    """Read sample dates from a tab-separated (optionally gzipped) metadata file with sample IDs in the first column.
+
+    Returns the set of samples dated within the given number of days of the most recent date in the file.
+    """
+    if metadata_file.endswith(".gz"):
+        inf = gzip.open(metadata_file, 'rt')
+    else:
+        inf = open(metadata_file)
+    with inf:
+        headers = inf.readline().rstrip('\n').split('\t')
+        if date_column not in headers:
+            raise ValueError("Column '{}' not found in metadata file headers.".format(date_column))
+        col_index = headers.index(date_column)
+        dates = {}
+        for line in inf:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) <= col_index:
+                continue
+            date = parse_date(parts[col_index])
+            if date != None:
+                dates[parts[0]] = date
+    if len(dates) == 0:
+        raise ValueError("No parseable dates found in column '{}'.".format(date_column))
+    cutoff = max(dates.values()) - datetime.timedelta(days=days)
+    return {sample for sample, date in dates.items() if date >= cutoff}
+
+def get_recent_counts(t, recent):
+    """Count the recent samples descended from every node in one postorder pass."""
+    recent_counts = {}
+    for node in reversed(t.depth_first_expansion()):
+        if node.is_leaf():
+            recent_counts[node.id] = 1 if node.id in recent else 0
+        else:
+            recent_counts[node.id] = sum([recent_counts[child.id] for child in node.children])
+    return recent_counts
+
 def filter_annotes(t, annotes, selection):
+    """Keep only annotations that have one of the selected lineages on their ancestry path.
+
+    Returns the filtered annotations and, for each, the outermost selected lineage it descends from,
+    so that selected lineages nested within another selected lineage are only processed once.
+    """
     filtered = {}
+    groups = {}
     for ann, nid in annotes.items():
         ancestry = t.rsearch(nid,True)
         for a in ancestry:
-            if selection in a.annotations:
-                filtered[ann] = nid
-    return filtered
+            for s in selection:
+                if s in a.annotations:
+                    filtered[ann] = nid
+                    #ancestry runs toward the root, so the last match is the outermost.
+                    groups[ann] = s
+    return filtered, groups
+
+def parse_selection(selection):
+    """Parse the -a argument, either a comma-separated list of lineages or a file with one lineage per line."""
+    if os.path.isfile(selection):
+        lineages = []
+        with open(selection) as inf:
+            for entry in inf:
+                entry = entry.strip()
+                if entry == "" or entry[0] == "#":
+                    continue
+                lineages.append(entry.split()[0])
+    else:
+        lineages = [l for l in selection.split(",") if l != ""]
+    #deduplicate while keeping the given order.
+    return list(dict.fromkeys(lineages))
+
+def split_path(path, lineage):
+    """Name a per-lineage output file by inserting the lineage before the extension."""
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, lineage, ext)
+
+def print_labels(t, annotes, f):
+    labels = {}
+    for ann, nid in annotes.items():
+        try:
+            ann = global_aliasor.compress(ann)
+        except:
+            # print(f"Could not compress lineage {ann}")
+            pass
+        for leaf in t.get_leaves_ids(nid):
+            if leaf not in labels:
+                labels[leaf] = [ann]
+            else:
+                labels[leaf].append(ann)
+    #format this in a way that's parsed by matUtils annotate -c
+    for l,v in labels.items():
+        for ann in v:
+            print("{}\t{}".format(ann,l),file=f)
+
+def write_labels(t, annotes, labels_file):
+    with open(labels_file,'w+') as f:
+        print_labels(t, annotes, f)
 
 def parse_aaweights(aaf):
     aad = {}
@@ -231,12 +562,48 @@ def parse_aaweights(aaf):
             aad[(gene, site, state)] = float(weight)
     return aad
 
+def get_node_annotations(annotes):
+    """Convert a lineage to node dictionary into the node to annotations dictionary used by bte, compressing lineage names where possible.
+    """
+    annd = {}
+    for k,v in annotes.items():
+        try:
+            k = global_aliasor.compress(k)
+        except:
+            # print(f"Could not compress lineage {k}")
+            pass
+
+        #LOOK AT THIS : SEE IF IT MAKE SENSE FOR 2 ANNOTATIONS
+        if v not in annd:
+
+            annd[v] = []
+        if len(annd[v]) == 2:
+            annd[v][1] = k
+        else:
+            annd[v].append(k)
+    return annd
+
+def print_annotation_rows(f, annd, nodes):
+    for nid in sorted(nodes):
+        print("\t".join([nid] + annd[nid]),file=f)
+
+def write_annotation_delta(delta_file, annd, nodes, clear = False):
+    """Write the annotations of the indicated nodes as a tab-separated node ID and annotation(s) table.
+    A leading #clear line records that all preexisting annotations were removed (-c).
+    Applied to the input protobuf by convert_autolinpb_totax.py --delta, so the full tree does not need to be saved with -o.
+    """
+    with open(delta_file,'w+') as f:
+        if clear:
+            print("#clear",file=f)
+        print_annotation_rows(f, annd, nodes)
+
 def argparser():
     parser = argparse.ArgumentParser(description="Propose sublineages for existing lineages based on relative representation concept.")
-    parser.add_argument("-i", "--input", required=True, help='Path to protobuf to annotate.')
+    parser.add_argument("-i", "--input", required=True, help='Path to protobuf to annotate, or a Taxonium jsonl(.gz) tree (read without bte; -o and translation are not available).')
     parser.add_argument("-c", "--clear", action='store_true', help='Clear all current annotations and apply a level of serial annotations to start with.')
     parser.add_argument("-r", "--recursive", action='store_true', help='Recursively add additional sublineages to proposed lineages.')
     parser.add_argument("-o", "--output", help='Path to output protobuf, if desired.',default=None)
+    parser.add_argument("-x", "--delta", help="Write only the annotations of nodes carrying proposed lineages to a table (node ID, annotations), instead of saving the whole protobuf. Apply to the input protobuf with convert_autolinpb_totax.py --delta.",default=None)
     parser.add_argument("-d", "--dump", help="Print proposed sublineages to a table.",default=None)
     parser.add_argument("-l", "--labels", help="Print lineage and sample associations to a table formatted for matUtils annotate -c.",default=None)
     parser.add_argument("-t", "--distinction", help="Require that lineage proposals have at least t mutations distinguishing them from the parent lineage or root.",type=int,default=1)
@@ -249,13 +616,42 @@ def argparser():
     parser.add_argument("-f", "--floor", help="Minimum score value to report a lineage. Default 0", type=float,default=0)
     parser.add_argument("--gtf", help="Path to a gtf file to apply translation. Use with --reference.")
     parser.add_argument("--reference", help='Path to a reference fasta file to apply translation. Use with --gtf.')
+    parser.add_argument("--cladecounts",help='Path to write the number of samples in each existing and proposed lineage (inclusive_count) and the number not in any of its sublineages (exclusive_count), as matUtils summary -c would for the annotated tree.',default=None)
+    parser.add_argument("--scores",help='Path to write the score of every internal node against its parent lineage, with its components (count, distinction, mean distance), from the first pass over each lineage, as a NumPy .npz file with one array per column.',default=None)
+    parser.add_argument("--progressive",action='store_true',help='Write out the dump and labels tables as each level of proposals completes, instead of only at the end, so results can be used while deeper levels (-r) are still running.')
+    parser.add_argument("--partial",help='Path to write the annotations proposed at each level as they complete, in the --delta format with a "#level N" line after each completed level and "#complete" at the end. Implies --progressive.',default=None)
     parser.add_argument("-v","--verbose",help='Print status updates.',action='store_true')
-    parser.add_argument("-a","--annotation",help='Choose a specific lineage, and its sublineages, to propose new sublineages for.',default=None)
+    parser.add_argument("-a","--annotation",help='Choose specific lineages, and their sublineages, to propose new sublineages for. Either a comma-separated list of lineages or a file with one lineage per line.',default=None)
+    parser.add_argument("--split",action='store_true',help='With -a, also write the dump and labels tables separately for each selected lineage, named by inserting the lineage before the file extension.')
+    parser.add_argument("--approximate",help='Screen candidate sublineages using sums and counts estimated from a subsample of this many leaves per lineage, rescoring only the top candidates exactly. Useful for very large trees.',type=int,default=None)
+    parser.add_argument("--screen",help='Number of top approximate candidates to rescore exactly per proposal when using --approximate. Default 20',type=int,default=20)
+    parser.add_argument("--seed",help='Random seed for --approximate leaf sampling. Default 1',type=int,default=1)
+    parser.add_argument("--validate-screen",action='store_true',help='With --approximate, also run the exact search at every proposal step and report how often the screened choice scores below the exact best candidate. Costs a full exact pass per step; for checking --approximate and --screen settings.')
+    parser.add_argument("--metadata",help='Path to a tab-separated (optionally gzipped) metadata file with sample IDs in the first column, used with --date-column and --recent.',default=None)
+    parser.add_argument("--date-column",help='Name of the metadata column containing sample dates (YYYY-MM-DD).',default="date")
+    parser.add_argument("--recent",help='Only propose sublineages for lineages and candidate branches with at least one sample dated within this many days of the most recent sample. Requires --metadata.',type=int,default=None)
+    parser.add_argument("--recent-only",action='store_true',help='With --recent, also ignore samples outside of the window when computing lineage sizes and scores.')
     parser.add_argument("-p","--samples",help='Path to a space-delimited file containing samples and weights in the first and second columns. If used, samples not included in this file will be ignored.',default=None)
     return parser
 
-def propose(args):
-    t = bte.MATree(args.input)
+def load_tree(path):
+    """Load a protobuf with bte, or a Taxonium jsonl(.gz) tree with taxonium_tree."""
+    if path.endswith(".jsonl") or path.endswith(".jsonl.gz"):
+        #imported here so protobuf input needs only bte
+        from taxonium_tree import TaxoniumTree
+        return TaxoniumTree(path)
+    if bte == None:
+        print("ERROR: bte is required to read protobuf input.")
+        exit(1)
+    return bte.MATree(path)
+
+def propose(args, t = None):
+    """Run the proposal for parsed arguments. t is the already loaded -i tree, if it is in memory."""
+    if (args.input.endswith(".jsonl") or args.input.endswith(".jsonl.gz")) and (args.output != None or args.gtf != None):
+        print("ERROR: Saving a protobuf (-o) and translation (--gtf) require protobuf input; use -d, -l or -x with Taxonium jsonl input.")
+        exit(1)
+    if t == None:
+        t = load_tree(args.input)
     mutweights = {}
     if args.gene == 'ORF1a' or args.gene == 'ORF1b':
         print("WARNING: ORF1a and ORF1b are treated as a unified ORF1ab for purposes of haplotype identification due to complexities with redundant counting and translation implementation.")
@@ -298,15 +694,29 @@ def propose(args):
         if args.clear:
             print("ERROR: Cannot select lineages (-a) while clearing lineages (-c)!")
             exit(1)
-        #only keep annotations that have the indicated annotation on their ancestry path.
+        #only keep annotations that have the indicated annotations on their ancestry path.
+        selection = parse_selection(args.annotation)
         if args.verbose:
-            print("Finding annotations that are descendants of {}.".format(args.annotation))
-        annotes = filter_annotes(t, annotes, args.annotation)
+            print("Finding annotations that are descendants of {}.".format(", ".join(selection)))
+        annotes, groups = filter_annotes(t, annotes, selection)
+        found = set()
+        for nid in annotes.values():
+            found.update([s for s in selection if s in t.get_node(nid).annotations])
+        for s in selection:
+            if s not in found:
+                print("WARNING: Selected lineage {} was not found in the tree.".format(s))
+            elif s not in groups.values():
+                print("Selected lineage {} is a sublineage of another selected lineage; proposing for it as part of that lineage.".format(s))
+        selection = [s for s in selection if s in groups.values()]
         if args.verbose:
             print("Found {} annotations to check for sublineages.".format(len(annotes)))
+    else:
+        selection = []
+        groups = {}
     if args.clear:
         assert len(annotes) == 0
     ann_net = build_annotation_network(t, annotes)
+    leaf_order, leaf_ranges = build_leaf_ranges(t)
     original_annotations = set(annotes.keys())
     global_used_nodes = get_skipset(t, annotes)
     if len(annotes) == 0:
@@ -323,8 +733,15 @@ def propose(args):
         print("Tree contains {} annotated lineages initially ({} nodes disregarded to prevent retroactive parent assignment).".format(len(annotes),len(global_used_nodes)))
     #keep going until the length of the annotation dictionary doesn't change.
     if args.dump != None:
-        print("parent\tparent_nid\tproposed_sublineage\tproposed_sublineage_nid\tproposed_sublineage_score\tproposed_sublineage_size",file=dumpf)
+        dump_header = "parent\tparent_nid\tproposed_sublineage\tproposed_sublineage_nid\tproposed_sublineage_score\tproposed_sublineage_size"
+        print(dump_header,file=dumpf)
+        group_dumpf = {}
+        if args.split:
+            for s in selection:
+                group_dumpf[s] = open(split_path(args.dump, s),'w+')
+                print(dump_header,file=group_dumpf[s])
     outer_annotes = annotes
+    child_lineages = build_lineage_index(annotes, ann_net)
     global_labeled = set()
     sample_weights = {}
     if args.samples != None:
@@ -335,6 +752,45 @@ def propose(args):
                 global_labeled.add(s)
         if args.verbose:
             print("{} samples given weights; ignoring {} samples".format(len(sample_weights),len(global_labeled)))
+    recent_counts = None
+    if args.recent != None:
+        if args.metadata == None:
+            print("ERROR: --recent requires --metadata!")
+            exit(1)
+        recent = read_recent_samples(args.metadata, args.date_column, args.recent)
+        recent_counts = get_recent_counts(t, recent)
+        if args.verbose:
+            print("{} samples in the tree are within {} days of the most recent sample.".format(recent_counts[t.root.id], args.recent))
+        if args.recent_only:
+            for s in t.get_leaves_ids():
+                if s not in recent:
+                    global_labeled.add(s)
+    progressive = args.progressive or args.partial != None
+    if progressive:
+        #preexisting lineages are written up front; each level's proposals are appended as it completes.
+        labelsf = None
+        group_labelsf = {}
+        if args.labels != None:
+            labelsf = open(args.labels,'w+')
+            print_labels(t, annotes, labelsf)
+            if args.split:
+                for s in selection:
+                    group_labelsf[s] = open(split_path(args.labels, s),'w+')
+                    print_labels(t, {ann:nid for ann, nid in annotes.items() if groups.get(ann) == s}, group_labelsf[s])
+        partialf = None
+        if args.partial != None:
+            partialf = open(args.partial,'w+')
+            if args.clear:
+                print("#clear",file=partialf)
+    if args.scores != None:
+        scores = new_score_surface()
+    if args.approximate != None:
+        rng = random.Random(args.seed)
+        screen_steps = 0
+        screen_reranked = 0
+        screen_rescored = 0
+        validated_steps = 0
+        screen_misses = 0
     level = 1
     while True:
         if args.verbose:
@@ -345,26 +801,66 @@ def propose(args):
             serial = 1
             rbfs = t.breadth_first_expansion(nid, True) #takes the name
             if len(sample_weights) == 0:
-                parent_leaf_count = len([n for n in rbfs if n.is_leaf()])
+                parent_leaf_count = leaf_ranges[nid][1] - leaf_ranges[nid][0]
             else:
                 parent_leaf_count = len([n for n in rbfs if n.id in sample_weights])
             if parent_leaf_count == 0:
                 if args.verbose:
                     print("No samples descended from {} have weight; continuing".format(ann))
                 continue
-            current_child_lineages = {k:v for k,v in annotes.items() if ann in ann_net.get(k,[])}
+            if recent_counts != None and recent_counts[nid] == 0:
+                if args.verbose:
+                    print("No recent samples descended from {}; continuing".format(ann))
+                continue
+            current_child_lineages = {k:annotes[k] for k in child_lineages.get(ann,[]) if k in annotes}
             labeled = global_labeled.copy()
             for lin, cnid in current_child_lineages.items():
-                for s in t.get_leaves_ids(cnid):
-                    labeled.add(s)
+                start, end = leaf_ranges[cnid]
+                labeled.update(leaf_order[start:end])
             if len(current_child_lineages) > 0 and args.verbose:
                 print("Found {} child lineages preexisting for lineage {}; {} samples prelabeled from {} total ({}%)".format(len(current_child_lineages), ann, len(labeled)-len(global_labeled), parent_leaf_count, 100*(len(labeled)-len(global_labeled))/parent_leaf_count))
             # print("DEBUG: Checking annotation {} with {} descendent nodes.".format(nid, len(rbfs)))
             dist_root = dists_to_root(t.get_node(nid), mutweights) #needs the node object, not just the name
+            rbfs_rank = {n.id:i for i,n in enumerate(rbfs)}
+            if args.scores != None:
+                #always exact, including with --approximate.
+                first_pass = get_sum_and_count(rbfs, ignore = labeled, mutweights = mutweights, sampleweights = sample_weights)
+                add_score_surface(scores, ann, nid, rbfs, first_pass[0], dist_root, args.minsamples, args.distinction, used_nodes)
+            else:
+                first_pass = None
+            if args.approximate != None:
+                leaf_count = len([n for n in rbfs if n.is_leaf()])
+                sampled, unlabeled_count = sample_leaves(rbfs, labeled, args.approximate, rng)
+                path_sums = {}
+                add_sampled_paths(nid, sampled.values(), dist_root, path_sums, mutweights, sample_weights)
+                leaf_table = lineage_leaf_table(t, nid, leaf_order, leaf_ranges, dist_root, labeled, sample_weights)
             while True:
-                scdict, leaf_count = get_sum_and_count(rbfs, ignore = labeled, mutweights = mutweights, sampleweights = sample_weights)
-                # print("DEBUG: total distances to root {}, total sums {}".format(sum(dist_root.values()),sum([v[0] for v in scdict.values()])))
-                best_score, best_node = evaluate_lineage(t, dist_root, nid, rbfs, scdict, args.minsamples, args.distinction, used_nodes)
+                if args.approximate != None:
+                    if len(sampled) == 0:
+                        break
+                    approx_scdict = estimate_sum_and_count(t, nid, path_sums, unlabeled_count/len(sampled), dist_root, mutweights)
+                    (best_score, best_node), top_kept, rescored = screen_lineage(t, dist_root, nid, approx_scdict, args.screen, leaf_table, leaf_ranges, args.minsamples, args.distinction, used_nodes, recent_counts)
+                    screen_rescored += rescored
+                    if best_node != None:
+                        screen_steps += 1
+                        if not top_kept:
+                            screen_reranked += 1
+                    if args.validate_screen:
+                        scdict, _ = get_sum_and_count(rbfs, ignore = labeled, mutweights = mutweights, sampleweights = sample_weights)
+                        exact_score, exact_node = search_lineage(t, dist_root, nid, rbfs_rank, scdict, args.minsamples, args.distinction, used_nodes, recent_counts)
+                        if exact_node != None:
+                            validated_steps += 1
+                            if best_score < exact_score:
+                                screen_misses += 1
+                else:
+                    if first_pass != None:
+                        #nothing has been labeled since the --scores pass, so its sums and counts are still current.
+                        scdict, leaf_count = first_pass
+                        first_pass = None
+                    else:
+                        scdict, leaf_count = get_sum_and_count(rbfs, ignore = labeled, mutweights = mutweights, sampleweights = sample_weights)
+                    # print("DEBUG: total distances to root {}, total sums {}".format(sum(dist_root.values()),sum([v[0] for v in scdict.values()])))
+                    best_score, best_node = search_lineage(t, dist_root, nid, rbfs_rank, scdict, args.minsamples, args.distinction, used_nodes, recent_counts)
                 if best_score <= args.floor:
                     # print("DEBUG: Best doesn't pass threshold with score {} out of {}".format(best_score, args.floor))
                     break
@@ -379,9 +875,21 @@ def propose(args):
                 for anc in t.rsearch(best_node.id,True):
                     used_nodes.add(anc.id)
                 new_annotes[newname] = best_node.id
-                leaves = t.get_leaves_ids(best_node.id)
+                if ann in groups:
+                    groups[newname] = groups[ann]
+                add_to_lineage_index(child_lineages, ann, newname)
+                start, end = leaf_ranges[best_node.id]
+                leaves = leaf_order[start:end]
                 if args.dump != None:
-                    print("{}\t{}\t{}\t{}\t{}\t{}".format(ann,nid,newname,best_node.id,str(best_score),len(leaves)),file=dumpf)
+                    row = "{}\t{}\t{}\t{}\t{}\t{}".format(ann,nid,newname,best_node.id,str(best_score),len(leaves))
+                    print(row,file=dumpf)
+                    if groups.get(ann) in group_dumpf:
+                        print(row,file=group_dumpf[groups[ann]])
+                if args.approximate != None:
+                    unlabeled_count -= len([l for l in leaves if l not in labeled])
+                    removed = [sampled.pop(l) for l in leaves if l in sampled]
+                    add_sampled_paths(nid, removed, dist_root, path_sums, mutweights, sample_weights, sign = -1)
+                    label_leaves(leaf_table, leaf_ranges, best_node.id)
                 for l in leaves:
                     labeled.add(l)
                 if len(labeled) >= leaf_count * args.cutoff:
@@ -389,6 +897,23 @@ def propose(args):
                 serial += 1
                 if args.verbose:
                     print("Annotated lineage {} as descendent of {} from level {} with {} descendents".format(newname, ann, level, len(leaves)))
+        if progressive:
+            if args.dump != None:
+                dumpf.flush()
+                for f in group_dumpf.values():
+                    f.flush()
+            if labelsf != None:
+                print_labels(t, new_annotes, labelsf)
+                labelsf.flush()
+                for s, f in group_labelsf.items():
+                    print_labels(t, {ann:nid for ann, nid in new_annotes.items() if groups.get(ann) == s}, f)
+                    f.flush()
+            if partialf != None:
+                print_annotation_rows(partialf, get_node_annotations(new_annotes), set(new_annotes.values()))
+                print("#level {}".format(level),file=partialf)
+                partialf.flush()
+            if args.verbose:
+                print("Wrote {} proposals from level {}.".format(len(new_annotes), level))
         if not args.recursive:
             annotes.update(new_annotes)
             break
@@ -398,48 +923,57 @@ def propose(args):
             annotes.update(new_annotes)
             outer_annotes = new_annotes
             level += 1
+    if args.scores != None:
+        write_score_surface(args.scores, scores)
+    if args.approximate != None:
+        print("Approximate screening: {} candidate nodes were rescored exactly in total (at most --screen {} per step).".format(screen_rescored, args.screen))
+    if args.approximate != None and screen_steps > 0:
+        print("Approximate screening: exact rescoring chose a different candidate than the top approximate one in {} of {} proposals ({:.1f}%).".format(screen_reranked, screen_steps, 100*screen_reranked/screen_steps))
+    if args.approximate != None and args.validate_screen and validated_steps > 0:
+        print("Approximate screening: the screened choice scored below the exact best candidate in {} of {} proposal steps ({:.1f}%).".format(screen_misses, validated_steps, 100*screen_misses/validated_steps))
     if args.verbose:
         print("After sublineage annotation, tree contains {} annotated lineages.".format(len(annotes)),file=sys.stderr)
-    if args.output != None:
-        annd = {}
-        for k,v in annotes.items():
-            try:
-                k = global_aliasor.compress(k)
-            except:
-                # print(f"Could not compress lineage {k}")
-                pass
-
-            #LOOK AT THIS : SEE IF IT MAKE SENSE FOR 2 ANNOTATIONS
-            if v not in annd:
-
-                annd[v] = []
-            if len(annd[v]) == 2:
-                annd[v][1] = k
-            else:
-                annd[v].append(k)
+    if args.output != None or args.delta != None:
+        annd = get_node_annotations(annotes)
         # print(f"DEBUG: final size of annotation dict {len(annd)}")
-        t.apply_node_annotations(annd)
-        t.save_pb(args.output)
+        if args.delta != None:
+            #only the nodes carrying newly proposed lineages need to be written.
+            new_nodes = {nid for ann, nid in annotes.items() if ann not in original_annotations}
+            write_annotation_delta(args.delta, annd, new_nodes, args.clear)
+            if args.verbose:
+                print("Wrote annotation delta for {} nodes to {}.".format(len(new_nodes), args.delta))
+        if args.output != None:
+            t.apply_node_annotations(annd)
+            t.save_pb(args.output)
+    if args.cladecounts != None:
+        #the tree's own annotations (already updated if saved with -o), with the nodes of proposed lineages updated as the delta would update them.
+        node_annotations = {}
+        for node in t.depth_first_expansion():
+            if any([ann != "" for ann in node.annotations]):
+                node_annotations[node.id] = list(node.annotations)
+        if args.output == None:
+            annd = get_node_annotations(annotes)
+            for nid in {nid for ann, nid in annotes.items() if ann not in original_annotations}:
+                node_annotations[nid] = annd[nid]
+        preorder = [(node.id, [child.id for child in node.children], node_annotations.get(node.id, []), 1 if node.is_leaf() else 0) for node in t.depth_first_expansion()]
+        write_clade_counts(args.cladecounts, get_clade_counts(preorder))
     if args.dump != None:
         dumpf.close()
-    if args.labels != None:
-        labels = {}
-        for ann, nid in annotes.items():
-            try:
-                ann = global_aliasor.compress(ann)
-            except:
-                # print(f"Could not compress lineage {ann}")
-                pass
-            for leaf in t.get_leaves_ids(nid):
-                if leaf not in labels:
-                    labels[leaf] = [ann]
-                else:
-                    labels[leaf].append(ann)
-        #format this in a way that's parsed by matUtils annotate -c
-        with open(args.labels,'w+') as f:
-            for l,v in labels.items():
-                for ann in v:
-                    print("{}\t{}".format(ann,l),file=f)
+        for f in group_dumpf.values():
+            f.close()
+    if progressive:
+        if labelsf != None:
+            labelsf.close()
+            for f in group_labelsf.values():
+                f.close()
+        if partialf != None:
+            print("#complete",file=partialf)
+            partialf.close()
+    elif args.labels != None:
+        write_labels(t, annotes, args.labels)
+        if args.split:
+            for s in selection:
+                write_labels(t, {ann:nid for ann, nid in annotes.items() if groups.get(ann) == s}, split_path(args.labels, s))
 
 def main():
     parser = argparser()
@@ -0,0 +1,196 @@
+import gzip
+import json
+from array import array
+from collections import deque
+
+'''
+Lets propose_sublineages.py run directly on a Taxonium jsonl tree (e.g. the ones in this directory, or a tree exported from the UI)
+without bte, matUtils or a protobuf. TaxoniumTree provides the parts of the bte MATree interface that autolin uses.
+It can also be built from an already parsed protobuf, so autolin.py run does not load the tree again with bte.
+'''
+
+NUC = "ACGT"
+
+class TaxoniumNode:
+    __slots__ = ("id", "parent", "children", "annotations", "mutation_ids", "table")
+
+    def __init__(self, id, mutation_ids, annotations, table):
+        self.id = id
+        self.parent = None
+        self.children = []
+        self.annotations = annotations
+        self.mutation_ids = mutation_ids
+        self.table = table
+
+    def is_leaf(self):
+        return len(self.children) == 0
+
+    @property
+    def mutations(self):
+        return [self.table[i] for i in self.mutation_ids]
+
+    @property
+    def branch_length(self):
+        #as in a MAT, the branch length is the number of nucleotide mutations on the branch.
+        return len(self.mutation_ids)
+
+    def most_recent_annotation(self):
+        """Return the nearest annotation of each annotation type on the path from this node to the root (None if there is none)."""
+        slots = len(self.annotations)
+        recent = [None] * slots
+        missing = slots
+        node = self
+        while node != None and missing > 0:
+            for i, ann in enumerate(node.annotations):
+                if ann != "" and recent[i] == None:
+                    recent[i] = ann
+                    missing -= 1
+            node = node.parent
+        return recent
+
+class TaxoniumTree:
+    def __init__(self, jsonl_file):
+        """Stream-parse a Taxonium jsonl(.gz) file into parent and mutation arrays, then link the nodes.
+
+        Internal nodes are named node_{node_id}, using the jsonl node IDs; samples keep their names.
+        Only nucleotide mutations are kept, so branch weights match those of the original MAT.
+        """
+        with open(jsonl_file, 'rb') as f:
+            gzipped = f.read(2) == b'\x1f\x8b'
+        inf = gzip.open(jsonl_file, 'rt') if gzipped else open(jsonl_file, 'r')
+        with inf:
+            header = json.loads(inf.readline())
+            table = []
+            is_nt = array('b')
+            for m in header["mutations"]:
+                if m["type"] == "nt":
+                    table.append("{}{}{}".format(m["previous_residue"], m["residue_pos"], m["new_residue"]))
+                    is_nt.append(1)
+                else:
+                    table.append(None)
+                    is_nt.append(0)
+            total = header["total_nodes"]
+            parents = array('l', [0] * total)
+            nodes = [None] * total
+            self.clade_types = None
+            for line in inf:
+                if line.strip() == "":
+                    continue
+                entry = json.loads(line)
+                index = entry["node_id"]
+                parents[index] = entry["parent_id"]
+                if self.clade_types == None:
+                    self.clade_types = list(entry.get("clades", {}).keys())
+                clades = entry.get("clades", {})
+                annotations = [clades.get(ct, "") for ct in self.clade_types]
+                mutation_ids = array('I', [i for i in entry["mutations"] if is_nt[i]])
+                name = entry["name"] if entry["is_tip"] and entry["name"] else "node_" + str(index)
+                nodes[index] = TaxoniumNode(name, mutation_ids, annotations, table)
+        self.root = None
+        for index, node in enumerate(nodes):
+            if parents[index] == index:
+                self.root = node
+                #the root's mutations record the reference sequence, not a branch.
+                node.mutation_ids = array('I')
+            else:
+                node.parent = nodes[parents[index]]
+                node.parent.children.append(node)
+        self.nodes = {node.id: node for node in nodes}
+
+    @classmethod
+    def from_protobuf(cls, data):
+        """Build the tree from an already parsed protobuf (parsimony_pb2.data), as bte loads it.
+
+        Internal nodes without a label are named node_1, node_2, ... in preorder. Condensed nodes are uncondensed as UShER does:
+        the node takes the name of its first sample, and the other samples are added after its parent's children with its mutations.
+        """
+        #imported here so jsonl input does not need taxoniumtools
+        from taxoniumtools.ushertools import ArrayTree
+        array_tree = ArrayTree()
+        for _ in array_tree.read_newick(data.newick, name_internal_nodes=True, branch_lengths=False):
+            pass
+        table = []
+        table_ids = {}
+        nodes = []
+        for index, mutation_list in zip(range(len(array_tree)), data.node_mutations):
+            mutation_ids = array('I')
+            for m in mutation_list.mutation:
+                mutation = "{}{}{}".format(NUC[m.par_nuc], m.position, NUC[m.mut_nuc[0]])
+                if mutation not in table_ids:
+                    table_ids[mutation] = len(table)
+                    table.append(mutation)
+                mutation_ids.append(table_ids[mutation])
+            annotations = list(data.metadata[index].clade_annotations) if index < len(data.metadata) else []
+            nodes.append(TaxoniumNode(array_tree.label[index], mutation_ids, annotations, table))
+        self = cls.__new__(cls)
+        self.clade_types = None
+        self.root = nodes[array_tree.root]
+        for index, node in enumerate(nodes):
+            if array_tree.parent[index] >= 0:
+                node.parent = nodes[array_tree.parent[index]]
+                node.parent.children.append(node)
+        self.nodes = {node.id: node for node in nodes}
+        for condensed in data.condensed_nodes:
+            node = self.nodes.get(condensed.node_name)
+            if node == None or len(condensed.condensed_leaves) == 0:
+                continue
+            del self.nodes[node.id]
+            node.id = condensed.condensed_leaves[0]
+            self.nodes[node.id] = node
+            parent = node.parent if node.parent != None else node
+            for sample in condensed.condensed_leaves[1:]:
+                leaf = TaxoniumNode(sample, array('I', node.mutation_ids), [""] * len(node.annotations), table)
+                leaf.parent = parent
+                parent.children.append(leaf)
+                self.nodes[sample] = leaf
+        return self
+
+    def get_node(self, nid):
+        return self.nodes[nid]
+
+    def depth_first_expansion(self, nid = None):
+        stack = [self.root if nid == None else self.nodes[nid]]
+        order = []
+        while len(stack) > 0:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(node.children))
+        return order
+
+    def breadth_first_expansion(self, nid = None, reverse = False):
+        queue = deque([self.root if nid == None else self.nodes[nid]])
+        order = []
+        while len(queue) > 0:
+            node = queue.popleft()
+            order.append(node)
+            queue.extend(node.children)
+        if reverse:
+            order.reverse()
+        return order
+
+    def rsearch(self, nid, include_self = False):
+        node = self.nodes[nid]
+        ancestors = [node] if include_self else []
+        node = node.parent
+        while node != None:
+            ancestors.append(node)
+            node = node.parent
+        return ancestors
+
+    def get_leaves(self, nid = None):
+        return [n for n in self.depth_first_expansion(nid) if n.is_leaf()]
+
+    def get_leaves_ids(self, nid = None):
+        return [n.id for n in self.get_leaves(nid)]
+
+    def get_annotations(self):
+        annotations = {}
+        for node in self.depth_first_expansion():
+            for ann in node.annotations:
+                if ann != "" and ann not in annotations:
+                    annotations[ann] = node.id
+        return annotations
+
+    def apply_node_annotations(self, annd):
+        for nid, anns in annd.items():
+            self.nodes[nid].annotations = list(anns)
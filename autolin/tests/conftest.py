@@ -0,0 +1,50 @@
+import os
+import random
+import sys
+
+import pytest
+
+#the scripts import each other as top level modules, as when they are run from the autolin directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from taxoniumtools import parsimony_pb2
+from taxonium_tree import TaxoniumTree
+
+def random_newick(rng, leaves):
+    """Join samples s1..sN into a random tree, merging two or three clades at a time."""
+    clades = ["s{}".format(i) for i in range(1, leaves + 1)]
+    while len(clades) > 1:
+        k = min(len(clades), rng.choice([2, 2, 3]))
+        picked = rng.sample(clades, k)
+        clades = [c for c in clades if c not in picked]
+        clades.append("(" + ",".join(picked) + ")")
+    return clades[0] + ";"
+
+def build_tree(newick, mutation_counts):
+    """Build a TaxoniumTree through a parsed protobuf, as autolin.py run does.
+
+    mutation_counts gives the number of mutations on each node in preorder; every mutation is at a new position.
+    """
+    data = parsimony_pb2.data()
+    data.newick = newick
+    position = 1
+    for count in mutation_counts:
+        mutation_list = data.node_mutations.add()
+        for _ in range(count):
+            m = mutation_list.mutation.add()
+            m.position = position
+            m.ref_nuc = 0
+            m.par_nuc = 0
+            m.mut_nuc.append(1)
+            position += 1
+    return TaxoniumTree.from_protobuf(data)
+
+@pytest.fixture
+def random_tree():
+    def make(seed, leaves = 40):
+        rng = random.Random(seed)
+        newick = random_newick(rng, leaves)
+        nodes = newick.count(",") + newick.count("(") + 1
+        #the root's mutations aren't a branch; zero length branches make ties.
+        return build_tree(newick, [0] + [rng.choice([0, 1, 1, 2, 3]) for _ in range(nodes - 1)])
+    return make
@@ -0,0 +1,73 @@
+import gzip
+import io
+import random
+
+import pytest
+
+from convert_autolinpb_totax import hash_join, partitioned_join, merge_meta, clade_table
+
+def fixture_tables(seed):
+    """Clade rows for samples s0..s59, and metadata for some of them plus samples not in the tree, with duplicate rows."""
+    rng = random.Random(seed)
+    rows = [["s{}".format(i), rng.choice(["A", "A.1", "B"]), "None"] for i in range(60)]
+    keys = rng.sample(["s{}".format(i) for i in range(60)], 40) + ["x{}".format(i) for i in range(10)]
+    meta_rows = [(key, [rng.choice(["UK", "US"]), str(i)]) for i, key in enumerate(keys)]
+    meta_rows += [(key, ["dup", "dup"]) for key in rng.sample(keys, 8)]
+    rng.shuffle(meta_rows)
+    return rows, meta_rows
+
+def reference_join(rows, meta_rows, left_join):
+    first = {}
+    for key, values in meta_rows:
+        first.setdefault(key, values)
+    samples = {row[0] for row in rows}
+    lines = []
+    for row in rows:
+        if row[0] in first:
+            lines.append("\t".join(row + first[row[0]]))
+        elif left_join:
+            lines.append("\t".join(row + ["", ""]))
+    missing = len([row for row in rows if row[0] not in first])
+    unused = len([key for key, _ in meta_rows if key not in samples])
+    return sorted(lines), (len(rows), missing, unused)
+
+def run_join(join, rows, meta_rows, *args):
+    out = io.StringIO()
+    #fresh copies, as the joins are given generators.
+    counts = join(iter([list(row) for row in rows]), iter([(key, list(values)) for key, values in meta_rows]), 2, *args, out)
+    return sorted(out.getvalue().splitlines()), counts
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("left_join", [True, False])
+def test_joins_agree(seed, left_join):
+    rows, meta_rows = fixture_tables(seed)
+    expected = reference_join(rows, meta_rows, left_join)
+    for build_meta in [True, False]:
+        assert run_join(hash_join, rows, meta_rows, left_join, build_meta) == expected
+    for partitions in [1, 3, 7]:
+        assert run_join(partitioned_join, rows, meta_rows, left_join, partitions) == expected
+
+@pytest.mark.parametrize("left_join", [True, False])
+@pytest.mark.parametrize("gzipped", [False, True])
+def test_merge_meta_partitioned_matches_in_memory(tmp_path, left_join, gzipped):
+    rows, meta_rows = fixture_tables(0)
+    amd = tmp_path / ("meta.tsv.gz" if gzipped else "meta.tsv")
+    text = "strain\tcountry\tdrug\tdate\n" + "".join("{}\t{}\tx\t{}\n".format(key, *values) for key, values in meta_rows)
+    if gzipped:
+        with gzip.open(amd, 'wt') as f:
+            f.write(text)
+    else:
+        amd.write_text(text)
+    sample_clades = {row[0]: row[1:2] for row in rows}
+    outputs = []
+    #a budget far below the table size forces on-disk partitions.
+    for memory_budget in [1024, 1e-6]:
+        header, clade_rows, clade_size = clade_table(sample_clades)
+        out = io.StringIO()
+        joined_header = merge_meta(str(amd), header, clade_rows, clade_size, out, ["country", "date"], left_join, memory_budget)
+        lines = out.getvalue().splitlines()
+        assert lines[0].split("\t") == joined_header == ["strain", "annotation_1", "country", "date"]
+        outputs.append(sorted(lines[1:]))
+    assert outputs[0] == outputs[1]
+    expected, _ = reference_join([row[:2] for row in rows], meta_rows, left_join)
+    assert outputs[0] == expected
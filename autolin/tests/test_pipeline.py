@@ -0,0 +1,59 @@
+import importlib
+import os
+import sys
+
+import taxoniumtools
+
+import autolin
+
+def make_stage(tmp_path, inputs, runs):
+    output = tmp_path / "out.txt"
+    def func():
+        runs.append(1)
+        output.write_text("".join(open(i).read() for i in inputs))
+    def stage(params, force = False):
+        #a new Pipeline each time, as for separate autolin.py run invocations.
+        return autolin.Pipeline(str(tmp_path / "work"), force).stage("stage", params, inputs, [str(output)], func)
+    return stage, output
+
+def test_stage_reruns_only_when_needed(tmp_path):
+    data = tmp_path / "in.txt"
+    data.write_text("a")
+    runs = []
+    stage, output = make_stage(tmp_path, [str(data)], runs)
+    assert stage({"x": 1})
+    assert not stage({"x": 1})
+    #a new modification time alone doesn't change the content hash.
+    st = os.stat(data)
+    os.utime(data, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert not stage({"x": 1})
+    data.write_text("bb")
+    assert stage({"x": 1})
+    assert stage({"x": 2})
+    assert not stage({"x": 2})
+    output.unlink()
+    assert stage({"x": 2})
+    assert stage({"x": 2}, force = True)
+    assert len(runs) == 5
+    assert os.path.exists(tmp_path / "work" / "autolin.cache.json")
+
+def test_stage_reruns_when_its_source_changes(tmp_path, monkeypatch):
+    module = tmp_path / "stage_module.py"
+    module.write_text("VALUE = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    stage_module = importlib.import_module("stage_module")
+    runs = []
+    stage, _ = make_stage(tmp_path, autolin.source_files(stage_module), runs)
+    assert stage({})
+    assert not stage({})
+    module.write_text("VALUE = 22\n")
+    assert stage({})
+    assert len(runs) == 2
+    sys.modules.pop("stage_module")
+
+def test_source_files_lists_package_modules():
+    files = autolin.source_files(autolin, taxoniumtools)
+    assert files[0] == autolin.__file__
+    package = [os.path.basename(f) for f in files[1:]]
+    assert "ushertools.py" in package and "usher_to_taxonium.py" in package
+    assert all(f.endswith(".py") for f in files)
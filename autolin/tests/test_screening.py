@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+from propose_sublineages import dists_to_root, get_sum_and_count, search_lineage, sample_leaves, add_sampled_paths, estimate_sum_and_count, \
+    build_leaf_ranges, lineage_leaf_table, label_leaves, exact_sum_and_count, screen_lineage
+
+def lineage(t, anid):
+    rbfs = t.breadth_first_expansion(anid, True)
+    return rbfs, {n.id:i for i,n in enumerate(rbfs)}, dists_to_root(t.get_node(anid))
+
+def assert_same_sums(t, anid, rbfs, table, leaf_ranges, dist_to_root, ignore, sampleweights):
+    expected, _ = get_sum_and_count(rbfs, ignore, sampleweights = sampleweights)
+    nids = [n.id for n in rbfs if not n.is_leaf() and n.id != anid]
+    exact = exact_sum_and_count(t, anid, nids, table, leaf_ranges, dist_to_root)
+    assert set(exact) == {nid for nid in nids if nid in expected}
+    for nid, (node_sum, node_count) in exact.items():
+        assert node_sum == pytest.approx(expected[nid][0])
+        assert node_count == pytest.approx(expected[nid][1])
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("weighted", [False, True])
+def test_exact_sums_match_full_pass(random_tree, seed, weighted):
+    t = random_tree(seed)
+    rng = random.Random(seed)
+    leaf_order, leaf_ranges = build_leaf_ranges(t)
+    leaves = t.get_leaves_ids()
+    #some samples count for nothing, so some internal nodes have no count at all.
+    sampleweights = {l: rng.choice([0, 0.5, 1, 2]) for l in leaves} if weighted else {}
+    internal = [n.id for n in t.depth_first_expansion() if not n.is_leaf()]
+    for anid in [t.root.id] + rng.sample(internal, 3):
+        rbfs, _, dist_to_root = lineage(t, anid)
+        ignore = set(rng.sample(leaves, len(leaves) // 5))
+        table = lineage_leaf_table(t, anid, leaf_order, leaf_ranges, dist_to_root, ignore, sampleweights)
+        assert_same_sums(t, anid, rbfs, table, leaf_ranges, dist_to_root, ignore, sampleweights)
+        #labeling a sublineage masks its leaves, as if they had been ignored from the start.
+        nid = rng.choice([n.id for n in rbfs if not n.is_leaf() and n.id != anid] or [anid])
+        label_leaves(table, leaf_ranges, nid)
+        start, end = leaf_ranges[nid]
+        ignore.update(leaf_order[start:end])
+        assert_same_sums(t, anid, rbfs, table, leaf_ranges, dist_to_root, ignore, sampleweights)
+
+def screen_steps(t, anid, steps, screen):
+    """Repeatedly label the best screened sublineage of anid, estimating from every leaf.
+
+    Returns the screened score, the exact best score of the same step and the number of nodes rescored, for each step.
+    """
+    leaf_order, leaf_ranges = build_leaf_ranges(t)
+    rbfs, rank, dist_to_root = lineage(t, anid)
+    labeled = set()
+    sampled, _ = sample_leaves(rbfs, labeled, len(rbfs), random.Random(0))
+    path_sums = {}
+    add_sampled_paths(anid, sampled.values(), dist_to_root, path_sums)
+    table = lineage_leaf_table(t, anid, leaf_order, leaf_ranges, dist_to_root, labeled)
+    used = set()
+    results = []
+    for _ in range(steps):
+        if len(sampled) == 0:
+            break
+        approx = estimate_sum_and_count(t, anid, path_sums, 1, dist_to_root)
+        (best_score, best_node), _, rescored = screen_lineage(t, dist_to_root, anid, approx, screen, table, leaf_ranges, banned = used)
+        sum_and_count, _ = get_sum_and_count(rbfs, ignore = labeled)
+        exact_score, _ = search_lineage(t, dist_to_root, anid, rank, sum_and_count, banned = used)
+        if best_node == None:
+            break
+        results.append((best_score, exact_score, rescored))
+        for anc in t.rsearch(best_node.id, True):
+            used.add(anc.id)
+        start, end = leaf_ranges[best_node.id]
+        removed = [sampled.pop(l) for l in leaf_order[start:end] if l in sampled]
+        add_sampled_paths(anid, removed, dist_to_root, path_sums, sign = -1)
+        label_leaves(table, leaf_ranges, best_node.id)
+        labeled.update(leaf_order[start:end])
+    return results
+
+@pytest.mark.parametrize("seed", range(20))
+def test_screen_of_every_candidate_is_exact(random_tree, seed):
+    #with every leaf sampled and every candidate rescored, screening must choose as well as the exact search at each step.
+    t = random_tree(seed)
+    steps = screen_steps(t, t.root.id, 5, len(t.nodes))
+    assert len(steps) > 0
+    for best_score, exact_score, _ in steps:
+        assert best_score == pytest.approx(exact_score)
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("screen", [1, 3])
+def test_screen_rescores_at_most_screen_nodes(random_tree, seed, screen):
+    t = random_tree(seed)
+    steps = screen_steps(t, t.root.id, 5, screen)
+    assert len(steps) > 0
+    for best_score, exact_score, rescored in steps:
+        assert 1 <= rescored <= screen
+        #a screened choice is exactly scored, so it can't beat the exact best.
+        assert best_score <= exact_score + 1e-9
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from propose_sublineages import dists_to_root, get_sum_and_count, evaluate_candidate, evaluate_lineage, search_lineage
+from conftest import build_tree
+
+def best_of_both(t, anid, minimum_size = 0, minimum_distinction = 0, banned = set(), ignore = set()):
+    rbfs = t.breadth_first_expansion(anid, True)
+    rank = {n.id:i for i,n in enumerate(rbfs)}
+    dist_to_root = dists_to_root(t.get_node(anid))
+    sum_and_count, _ = get_sum_and_count(rbfs, ignore)
+    exhaustive = evaluate_lineage(t, dist_to_root, anid, rbfs, sum_and_count, minimum_size, minimum_distinction, banned)
+    searched = search_lineage(t, dist_to_root, anid, rank, sum_and_count, minimum_size, minimum_distinction, banned)
+    return exhaustive, searched
+
+def node_id(node):
+    return None if node == None else node.id
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("minimum_size,minimum_distinction", [(0, 0), (2, 1), (5, 3)])
+def test_search_matches_exhaustive(random_tree, seed, minimum_size, minimum_distinction):
+    t = random_tree(seed)
+    rng = random.Random(seed)
+    internal = [n.id for n in t.depth_first_expansion() if not n.is_leaf()]
+    leaves = t.get_leaves_ids()
+    for anid in [t.root.id] + rng.sample(internal, 3):
+        banned = set(rng.sample(internal, len(internal) // 4))
+        ignore = set(rng.sample(leaves, len(leaves) // 5))
+        (escore, enode), (sscore, snode) = best_of_both(t, anid, minimum_size, minimum_distinction, banned, ignore)
+        assert sscore == escore
+        assert node_id(snode) == node_id(enode)
+
+def test_search_breaks_ties_as_exhaustive():
+    #a balanced tree with one mutation per branch: each side of the root scores the same, as does each of their children.
+    t = build_tree("(((a,b),(c,d)),((e,f),(g,h)));", [0] + [1] * 14)
+    rbfs = t.breadth_first_expansion(t.root.id, True)
+    dist_to_root = dists_to_root(t.root)
+    sum_and_count, _ = get_sum_and_count(rbfs)
+    scores = [evaluate_candidate(t.root.id, n.id, sum_and_count, dist_to_root) for n in rbfs if not n.is_leaf() and n != t.root]
+    assert scores.count(max(scores)) > 1
+    (escore, enode), (sscore, snode) = best_of_both(t, t.root.id)
+    assert sscore == escore == max(scores)
+    assert snode.id == enode.id
+    #banning the tie winner moves both to the same next candidate.
+    (escore, enode), (sscore, snode) = best_of_both(t, t.root.id, banned = {enode.id})
+    assert (sscore, snode.id) == (escore, enode.id)
+
+def test_search_without_candidates():
+    t = build_tree("((a,b),c);", [0, 0, 1, 1, 1])
+    (escore, enode), (sscore, snode) = best_of_both(t, t.root.id, minimum_size = 5)
+    assert (sscore, snode) == (escore, enode) == (0, None)
@@ -0,0 +1,178 @@
+"""Streaming reader for UShER mutation-annotated tree protobufs.
+
+Parsing the whole file with ParseFromString needs the complete decompressed
+file and the complete decoded message in memory at once. Instead, the
+top-level fields of the data message are read one at a time from the
+(possibly gzipped) stream, and each node_mutations and metadata entry is only
+decoded when the tree builder asks for it."""
+
+from collections import deque
+from . import parsimony_pb2
+
+NEWICK = 1
+NODE_MUTATIONS = 2
+CONDENSED_NODES = 3
+METADATA = 4
+
+
+class FieldReader:
+    """Reads (field number, payload) pairs from a stream of protobuf wire format, in chunks"""
+
+    def __init__(self, stream, chunk_size=1 << 20):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.pos = 0
+
+    def fill(self):
+        """Read the next chunk of the stream into the buffer, returning False at the end of the stream"""
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def read_varint(self):
+        """Read a varint, returning None if the stream ends before it starts"""
+        result = 0
+        shift = 0
+        while True:
+            if self.pos >= len(self.buffer) and not self.fill():
+                if shift == 0:
+                    return None
+                raise ValueError("Protobuf stream ends inside a varint")
+            byte = self.buffer[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return result
+            shift += 7
+
+    def read(self, n):
+        available = len(self.buffer) - self.pos
+        if n <= available:
+            data = self.buffer[self.pos:self.pos + n]
+            self.pos += n
+            return data
+        # Large payloads (e.g. the newick string) are read straight into
+        # their own buffer rather than through the chunk buffer
+        data = bytearray(n)
+        data[:available] = memoryview(self.buffer)[self.pos:]
+        self.buffer = b""
+        self.pos = 0
+        view = memoryview(data)
+        filled = available
+        while filled < n:
+            got = self.stream.readinto(view[filled:])
+            if not got:
+                raise ValueError("Protobuf stream ends inside a field")
+            filled += got
+        return data
+
+    def __iter__(self):
+        while True:
+            tag = self.read_varint()
+            if tag is None:
+                return
+            field_number, wire_type = tag >> 3, tag & 7
+            if wire_type == 2:
+                yield field_number, self.read(self.read_varint())
+            elif wire_type == 0:
+                self.read_varint()
+            elif wire_type == 1:
+                self.read(8)
+            elif wire_type == 5:
+                self.read(4)
+            else:
+                raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+
+
+class MATStream:
+    """Lazily decodes the fields of a parsimony_pb2.data message from a stream.
+
+    UShER writes the newick string first, then one node_mutations entry per
+    node in preorder, then the condensed nodes and then one metadata entry per
+    node. Entries are decoded one at a time in that order as they are asked
+    for; any that arrive earlier than they are needed are kept undecoded until
+    then. Metadata is skipped unless keep_metadata is set."""
+
+    def __init__(self, stream, keep_metadata=True):
+        self.fields = iter(FieldReader(stream))
+        self.keep_metadata = keep_metadata
+        self.pending = {
+            NEWICK: deque(),
+            NODE_MUTATIONS: deque(),
+            METADATA: deque()
+        }
+        self.condensed_nodes_dict = {}
+
+    def keep(self, field_number, payload):
+        if field_number == CONDENSED_NODES:
+            condensed_node = parsimony_pb2.condensed_node.FromString(payload)
+            self.condensed_nodes_dict[condensed_node.node_name] = list(
+                condensed_node.condensed_leaves)
+        elif field_number == METADATA and not self.keep_metadata:
+            pass
+        elif field_number in self.pending:
+            self.pending[field_number].append(payload)
+
+    def take(self, field_number):
+        """Return the payload of the next entry of a field, reading ahead as needed, or None if there are no more"""
+        if self.pending[field_number]:
+            return self.pending[field_number].popleft()
+        for number, payload in self.fields:
+            if number == field_number:
+                return payload
+            self.keep(number, payload)
+        return None
+
+    def newick(self):
+        payload = self.take(NEWICK)
+        return payload.decode("utf-8") if payload is not None else ""
+
+    def node_mutations(self):
+        """Yield each node's parsimony_pb2.mutation_list, in preorder"""
+        while True:
+            payload = self.take(NODE_MUTATIONS)
+            if payload is None:
+                return
+            yield parsimony_pb2.mutation_list.FromString(payload)
+
+    def metadata(self):
+        """Yield each node's parsimony_pb2.node_metadata, in preorder"""
+        while True:
+            payload = self.take(METADATA)
+            if payload is None:
+                return
+            yield parsimony_pb2.node_metadata.FromString(payload)
+
+    def condensed_nodes(self):
+        """Read the rest of the stream and return a dict of condensed node name to its leaves"""
+        for number, payload in self.fields:
+            self.keep(number, payload)
+        return self.condensed_nodes_dict
+
+
+class MATMessage:
+    """The MATStream interface over an already parsed parsimony_pb2.data
+    message, so a tree that is in memory is loaded without serialising it
+    again"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def newick(self):
+        return self.data.newick
+
+    def node_mutations(self):
+        return iter(self.data.node_mutations)
+
+    def metadata(self):
+        return iter(self.data.metadata)
+
+    def condensed_nodes(self):
+        return {
+            condensed_node.node_name: list(condensed_node.condensed_leaves)
+            for condensed_node in self.data.condensed_nodes
+        }
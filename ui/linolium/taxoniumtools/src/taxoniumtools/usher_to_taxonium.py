@@ -7,9 +7,11 @@ import datetime
 from alive_progress import config_handler, alive_it, alive_bar
 
 from . import ushertools
+from . import parsimony_pb2
 from . import utils
 import argparse
 import gzip
+from array import array
 
 try:
     from . import _version
@@ -38,7 +40,8 @@ def do_processing(input_file,
                   shear=False,
                   shear_threshold=1000,
                   only_variable_sites=False,
-                  key_column="strain"):
+                  key_column="strain",
+                  processes=1):
 
     metadata_dict, metadata_cols = utils.read_metadata(metadata_file, columns,
                                                        key_column)
@@ -55,7 +58,10 @@ def do_processing(input_file,
         html_content = open(overlay_html).read()
         config['overlay'] = html_content
 
-    if "gz" in input_file:
+    if isinstance(input_file, parsimony_pb2.data):
+        # Already parsed (e.g. with annotations applied in memory)
+        f = input_file
+    elif "gz" in input_file:
         f = gzip.open(input_file, 'rb')
     else:
         f = open(input_file, 'rb')
@@ -70,8 +76,10 @@ def do_processing(input_file,
         clade_types=clade_types,
         name_internal_nodes=name_internal_nodes,
         shear=shear,
-        shear_threshold=shear_threshold)
-    f.close()
+        shear_threshold=shear_threshold,
+        processes=processes)
+    if f is not input_file:
+        f.close()
 
     if hasattr(mat, "genes"):
         config['gene_details'] = mat.genes
@@ -91,55 +99,52 @@ def do_processing(input_file,
     print("Ladderizing tree..")
     mat.tree.ladderize(ascending=False)
     print("Ladderizing done")
-    total_tips = mat.tree.root.num_tips
-    utils.set_x_coords(mat.tree.root,
-                       chronumental_enabled=chronumental_enabled)
-    utils.set_terminal_y_coords(mat.tree.root)
-    utils.set_internal_y_coords(mat.tree.root)
+    root = mat.tree.root
+    total_tips = mat.tree.num_tips[root]
+    utils.set_array_x_coords(mat.tree,
+                             chronumental_enabled=chronumental_enabled)
+    utils.set_array_terminal_y_coords(mat.tree)
+    utils.set_array_internal_y_coords(mat.tree)
 
-    nodes_sorted_by_y = utils.sort_on_y(mat.tree)
-    all_aa_muts_objects = utils.get_all_aa_muts(mat.tree.root)
+    nodes_sorted_by_y = utils.sort_array_on_y(mat.tree)
+    mutation_table = mat.mutation_table
+    used_ids = utils.get_used_mutation_ids(mat.tree, len(mutation_table))
+    all_aa_mut_ids = [i for i in used_ids if mutation_table[i].type == "aa"]
     if only_variable_sites:
-        variable_muts = [
-            x for x in all_aa_muts_objects if x.initial_aa != x.final_aa
-        ]
-        variable_sites = set(
-            (x.gene, x.one_indexed_codon) for x in variable_muts)
-        all_aa_muts_objects = [
-            x for x in all_aa_muts_objects
-            if (x.gene, x.one_indexed_codon) in variable_sites
-        ]
-        mat.tree.root.aa_muts = [
-            x for x in mat.tree.root.aa_muts
-            if (x.gene, x.one_indexed_codon) in variable_sites
-        ]
-    all_nuc_muts = utils.get_all_nuc_muts(mat.tree.root)
+        variable_sites = set((mutation_table[i].gene,
+                              mutation_table[i].one_indexed_codon)
+                             for i in all_aa_mut_ids
+                             if mutation_table[i].initial_aa !=
+                             mutation_table[i].final_aa)
+        keep = lambda i: (mutation_table[i].gene, mutation_table[i].
+                          one_indexed_codon) in variable_sites
+        all_aa_mut_ids = [i for i in all_aa_mut_ids if keep(i)]
+        mat.tree.aa_mutation_ids[root] = array(
+            'I', [i for i in mat.tree.aa_mutation_ids[root] if keep(i)])
+    all_nuc_mut_ids = [i for i in used_ids if mutation_table[i].type == "nt"]
     if only_variable_sites:
-        variable_muts = [
-            x for x in all_nuc_muts
-            if x.par_nuc != x.mut_nuc and x.par_nuc != "X"
-        ]
         variable_sites = set(
-            (x.chromosome, x.one_indexed_position) for x in variable_muts)
-        all_nuc_muts = [
-            x for x in all_nuc_muts
-            if (x.chromosome, x.one_indexed_position) in variable_sites
-        ]
-        mat.tree.root.nuc_mutations = [
-            x for x in mat.tree.root.nuc_mutations
-            if (x.chromosome, x.one_indexed_position) in variable_sites
-        ]
-    all_mut_inputs = all_aa_muts_objects + all_nuc_muts
+            (mutation_table[i].chromosome,
+             mutation_table[i].one_indexed_position) for i in all_nuc_mut_ids
+            if mutation_table[i].par_nuc != mutation_table[i].mut_nuc
+            and mutation_table[i].par_nuc != "X")
+        keep = lambda i: (mutation_table[i].chromosome, mutation_table[i].
+                          one_indexed_position) in variable_sites
+        all_nuc_mut_ids = [i for i in all_nuc_mut_ids if keep(i)]
+        mat.tree.nuc_mutation_ids[root] = array(
+            'I', [i for i in mat.tree.nuc_mutation_ids[root] if keep(i)])
+    all_mut_ids = all_aa_mut_ids + all_nuc_mut_ids
     all_mut_objects = [
-        utils.make_aa_object(i, input_thing)
-        if input_thing.type == "aa" else utils.make_nuc_object(i, input_thing)
-        for i, input_thing in enumerate(all_mut_inputs)
+        utils.make_aa_object(i, mutation_table[mutation_id])
+        if mutation_table[mutation_id].type == "aa" else
+        utils.make_nuc_object(i, mutation_table[mutation_id])
+        for i, mutation_id in enumerate(all_mut_ids)
     ]
 
-    input_to_index = {
-        input_thing: i
-        for i, input_thing in enumerate(all_mut_inputs)
-    }
+    # Maps a mutation table index to its index in the output mutation list
+    input_to_index = array('i', [-1]) * len(mutation_table)
+    for i, mutation_id in enumerate(all_mut_ids):
+        input_to_index[mutation_id] = i
 
     config['num_tips'] = total_tips
     yyyymmdd = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -152,7 +157,9 @@ def do_processing(input_file,
         "config": config
     }
 
-    node_to_index = {node: i for i, node in enumerate(nodes_sorted_by_y)}
+    node_to_index = array('l', [-1]) * len(mat.tree)
+    for i, node in enumerate(nodes_sorted_by_y):
+        node_to_index[node] = i
 
     if "gz" in output_file:
         output_file = gzip.open(output_file, 'wb')
@@ -162,7 +169,8 @@ def do_processing(input_file,
     for node in alive_it(
             nodes_sorted_by_y,
             title="Converting each node, and writing out in JSON"):
-        node_object = utils.get_node_object(
+        node_object = utils.get_array_node_object(
+            mat.tree,
             node,
             node_to_index,
             metadata_dict,
@@ -306,6 +314,12 @@ def get_parser():
         help=
         "The column in the metadata file which is the same as the names in the tree",
         default="strain")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help=
+        "Number of processes to use for annotating amino acid mutations (only used with --genbank). The tree is split into subtrees that are annotated in parallel; the output is the same as with one process. Default 1",
+        default=1)
 
     return parser
 
@@ -335,7 +349,8 @@ def main():
         shear=args.shear,
         shear_threshold=args.shear_threshold,
         only_variable_sites=args.only_variable_sites,
-        key_column=args.key_column)
+        key_column=args.key_column,
+        processes=args.processes)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,16 @@
-from concurrent.futures import thread
+from . import protobuf_stream
 from . import parsimony_pb2
-import treeswift
 from alive_progress import alive_it, alive_bar
 from Bio import SeqIO
 from typing import ClassVar
 
 from dataclasses import dataclass
-from collections import defaultdict
+from array import array
+import hashlib
+import multiprocessing
+import os
+import re
+import numpy as np
 
 
 def reverse_complement(input_string):
@@ -36,31 +40,47 @@ class NucMutation:  #hashable
     type: str = "nt"
 
 
-@dataclass(eq=True, frozen=True)
-class Gene:
-    name: str
-    strand: int
-    start: int  # zero-indexed
-    end: int  # 0-indexed
+class MutationTable:
+    """Each distinct mutation is stored once; nodes hold array('I') indices into the table"""
 
+    def __init__(self):
+        self.mutations = []
+        self.ids = {}
+        self.nuc_ids = {}
 
-from dataclasses import dataclass
+    def __len__(self):
+        return len(self.mutations)
 
+    def __getitem__(self, i):
+        return self.mutations[i]
 
-@dataclass(eq=False)
-class Codon:
-    gene: Gene
-    codon_number: int  # zero-indexed
-    positions: dict  # zero-indexed positions e.g. {0:123,1:124,2:125}
-    strand: int
+    def intern(self, mutation):
+        i = self.ids.get(mutation)
+        if i is None:
+            i = len(self.mutations)
+            self.ids[mutation] = i
+            self.mutations.append(mutation)
+        return i
 
-    def __eq__(self, other):
-        if isinstance(other, Codon):
-            return self.gene == other.gene and self.codon_number == other.codon_number
-        return False
+    def intern_nuc(self, one_indexed_position, par_nuc, mut_nuc):
+        # Keyed on a plain tuple so a NucMutation is only created the first time
+        key = (one_indexed_position, par_nuc, mut_nuc)
+        i = self.nuc_ids.get(key)
+        if i is None:
+            i = self.intern(
+                NucMutation(one_indexed_position=one_indexed_position,
+                            par_nuc=par_nuc,
+                            mut_nuc=mut_nuc))
+            self.nuc_ids[key] = i
+        return i
 
-    def __hash__(self):
-        return hash((self.gene, self.codon_number))
+
+@dataclass(eq=True, frozen=True)
+class Gene:
+    name: str
+    strand: int
+    start: int  # zero-indexed
+    end: int  # 0-indexed
 
 
 def get_codon_table():
@@ -92,34 +112,214 @@ def get_genes_dict(cdses):
     return genes
 
 
+CODON_INDEX_VERSION = 1
+
+
+class CodonIndex:
+    """Maps genome positions to the codons of the CDS features covering them.
+
+    The codon table is a set of NumPy arrays with one row per codon: its gene
+    (an index into gene_names), zero-indexed codon number, the zero-indexed
+    genome positions of its three nucleotides and the gene's strand. The rows
+    of the codons covering position p are rows[offsets[p]:offsets[p + 1]]."""
+
+    def __init__(self, gene_names, codon_gene, codon_number, codon_positions,
+                 codon_strand, offsets, rows):
+        self.gene_names = list(gene_names)
+        self.codon_gene = codon_gene
+        self.codon_number = codon_number
+        self.codon_positions = codon_positions
+        self.codon_strand = codon_strand
+        self.offsets = offsets
+        self.rows = rows
+        # get_mutations reads through memoryviews, which return plain ints
+        self.codon_gene_view = memoryview(codon_gene)
+        self.codon_number_view = memoryview(codon_number)
+        self.codon_positions_view = memoryview(codon_positions.reshape(-1))
+        self.codon_strand_view = memoryview(codon_strand)
+        self.offsets_view = memoryview(offsets)
+        self.rows_view = memoryview(rows)
+        self.genome_length = len(offsets) - 1
+
+    def __reduce__(self):
+        # memoryviews can't be pickled, so rebuild them in the new process
+        return (CodonIndex, (self.gene_names, self.codon_gene,
+                             self.codon_number, self.codon_positions,
+                             self.codon_strand, self.offsets, self.rows))
+
+    @classmethod
+    def from_cdses(cls, cdses, genes, genome_length):
+        # Positions of each gene's codons by codon number and position in the
+        # codon. Later CDS features with the same gene name overwrite earlier
+        # ones where they overlap.
+        by_gene = {}
+        for feature in cdses:
+            parts = [
+                np.arange(part.start, part.end) if part.strand == 1 else
+                np.arange(part.end - 1, part.start - 1, -1)
+                for part in feature.location.parts
+            ]
+            positions = np.concatenate(parts) if parts else np.zeros(
+                0, dtype=np.int64)
+            gene_name = get_gene_name(feature)
+            gene_positions = by_gene.get(gene_name)
+            if gene_positions is None or len(gene_positions) < len(positions):
+                grown = np.full(-(-len(positions) // 3) * 3, -1, dtype=np.int64)
+                if gene_positions is not None:
+                    grown[:len(gene_positions)] = gene_positions
+                gene_positions = grown
+            gene_positions[:len(positions)] = positions
+            by_gene[gene_name] = gene_positions
+
+        gene_names = list(by_gene)
+        codon_positions = np.concatenate(
+            [by_gene[name].reshape(-1, 3)
+             for name in gene_names]) if gene_names else np.zeros(
+                 (0, 3), dtype=np.int64)
+        assert (codon_positions >= 0).all()
+        codon_gene = np.concatenate([
+            np.full(len(by_gene[name]) // 3, i, dtype=np.int32)
+            for i, name in enumerate(gene_names)
+        ]) if gene_names else np.zeros(0, dtype=np.int32)
+        codon_number = np.concatenate([
+            np.arange(len(by_gene[name]) // 3, dtype=np.int32)
+            for name in gene_names
+        ]) if gene_names else np.zeros(0, dtype=np.int32)
+        codon_strand = np.array([genes[name].strand for name in gene_names],
+                                dtype=np.int8)[codon_gene]
+
+        # Sort (position, row) pairs by position, keeping rows in order
+        flat_positions = codon_positions.reshape(-1)
+        order = np.argsort(flat_positions, kind="stable")
+        rows = (order // 3).astype(np.int32)
+        offsets = np.zeros(genome_length + 1, dtype=np.int64)
+        np.cumsum(np.bincount(flat_positions, minlength=genome_length),
+                  out=offsets[1:])
+        return cls(gene_names, codon_gene, codon_number, codon_positions,
+                   codon_strand, offsets, rows)
+
+    def codons_at(self, zero_indexed_pos):
+        if 0 <= zero_indexed_pos < self.genome_length:
+            return self.rows_view[self.offsets_view[zero_indexed_pos]:self.
+                                  offsets_view[zero_indexed_pos + 1]]
+        return ()
+
+    def positions(self, row):
+        return self.codon_positions_view[3 * row:3 * row + 3]
+
+
+def get_cache_dir():
+    if "TAXONIUMTOOLS_CACHE_DIR" in os.environ:
+        return os.environ["TAXONIUMTOOLS_CACHE_DIR"]
+    cache_home = os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache"))
+    return os.path.join(cache_home, "taxoniumtools")
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_reference(genbank_file):
+    """Read the reference sequence, genes and codon index from a GenBank file.
+
+    The result is cached in the taxoniumtools cache directory (set
+    TAXONIUMTOOLS_CACHE_DIR to change it), keyed by the file's hash, so later
+    conversions with the same GenBank file don't need to parse it again.
+    Returns (sequence, genes dict, CodonIndex)."""
+    cache_file = None
+    if isinstance(genbank_file, (str, os.PathLike)):
+        cache_file = os.path.join(
+            get_cache_dir(),
+            f"codon_index_v{CODON_INDEX_VERSION}_{file_sha256(genbank_file)}.npz"
+        )
+        if os.path.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    genes = {
+                        name: Gene(name, int(strand), int(start), int(end))
+                        for name, strand, start, end in zip(
+                            cached["gene_table_names"].tolist(),
+                            cached["gene_table"][:, 0].tolist(),
+                            cached["gene_table"][:, 1].tolist(),
+                            cached["gene_table"][:, 2].tolist())
+                    }
+                    codon_index = CodonIndex(cached["gene_names"].tolist(),
+                                             cached["codon_gene"],
+                                             cached["codon_number"],
+                                             cached["codon_positions"],
+                                             cached["codon_strand"],
+                                             cached["offsets"],
+                                             cached["rows"])
+                    seq = cached["sequence"].tobytes().decode()
+                print(f"Loaded codon index from cache {cache_file}")
+                return seq, genes, codon_index
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Could not read cached codon index {cache_file}: {e}")
+
+    genbank = SeqIO.read(genbank_file, "genbank")
+    cdses = [x for x in genbank.features if x.type == "CDS"]
+    genes = get_genes_dict(cdses)
+    seq = str(genbank.seq)
+    codon_index = CodonIndex.from_cdses(cdses, genes, len(seq))
+
+    if cache_file is not None:
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            temp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+            np.savez(temp_file,
+                     gene_table_names=np.array(list(genes), dtype=str),
+                     gene_table=np.array(
+                         [[gene.strand, gene.start, gene.end]
+                          for gene in genes.values()],
+                         dtype=np.int64).reshape(-1, 3),
+                     gene_names=np.array(codon_index.gene_names, dtype=str),
+                     codon_gene=codon_index.codon_gene,
+                     codon_number=codon_index.codon_number,
+                     codon_positions=codon_index.codon_positions,
+                     codon_strand=codon_index.codon_strand,
+                     offsets=codon_index.offsets,
+                     rows=codon_index.rows,
+                     sequence=np.frombuffer(seq.encode(), dtype=np.uint8))
+            os.replace(temp_file, cache_file)
+        except OSError as e:
+            print(f"Could not cache codon index in {cache_file}: {e}")
+    return seq, genes, codon_index
+
+
 def get_mutations(past_nuc_muts_dict,
                   new_nuc_mutations_here,
                   seq,
-                  nuc_to_codon,
+                  codon_index,
                   disable_check_for_differences=False):
 
-    by_codon = defaultdict(list)
+    by_codon = {}
 
     for mutation in new_nuc_mutations_here:
-        zero_indexed_pos = mutation.one_indexed_position - 1
-        if zero_indexed_pos in nuc_to_codon:
-            for codon in nuc_to_codon[zero_indexed_pos]:
-                by_codon[codon].append(mutation)
+        for row in codon_index.codons_at(mutation.one_indexed_position - 1):
+            if row in by_codon:
+                by_codon[row].append(mutation)
+            else:
+                by_codon[row] = [mutation]
 
     mutations_here = []
-    for gene_codon, mutations in by_codon.items():
+    for row, mutations in by_codon.items():
 
         # For most of this function we ignore strand - so for negative strand we
         # are actually collecting the complement of the codon
+        positions = codon_index.positions(row).tolist()
 
-        initial_codon = [seq[gene_codon.positions[x]] for x in range(3)]
+        initial_codon = [seq[x] for x in positions]
 
-        relevant_past_muts = [(x, past_nuc_muts_dict[x])
-                              for x in gene_codon.positions.values()
+        relevant_past_muts = [(x, past_nuc_muts_dict[x]) for x in positions
                               if x in past_nuc_muts_dict]
         flipped_dict = {
             position: offset
-            for offset, position in gene_codon.positions.items()
+            for offset, position in enumerate(positions)
         }
         for position, value in relevant_past_muts:
             initial_codon[flipped_dict[position]] = value
@@ -133,7 +333,7 @@ def get_mutations(past_nuc_muts_dict,
         initial_codon = "".join(initial_codon)
         final_codon = "".join(final_codon)
 
-        if gene_codon.strand == -1:
+        if codon_index.codon_strand_view[row] == -1:
 
             initial_codon = complement(initial_codon)
             final_codon = complement(final_codon)
@@ -144,11 +344,13 @@ def get_mutations(past_nuc_muts_dict,
             #(gene, codon_number + 1, initial_codon_trans, final_codon_trans)
 
             mutations_here.append(
-                AAMutation(gene=gene_codon.gene,
-                           one_indexed_codon=gene_codon.codon_number + 1,
+                AAMutation(gene=codon_index.gene_names[
+                    codon_index.codon_gene_view[row]],
+                           one_indexed_codon=codon_index.codon_number_view[row]
+                           + 1,
                            initial_aa=initial_codon_trans,
                            final_aa=final_codon_trans,
-                           nuc_for_codon=gene_codon.positions[1]))
+                           nuc_for_codon=positions[1]))
 
     # update past_nuc_muts_dict
     for mutation in new_nuc_mutations_here:
@@ -158,38 +360,449 @@ def get_mutations(past_nuc_muts_dict,
     return mutations_here
 
 
-def recursive_mutation_analysis(node, past_nuc_muts_dict, seq, cdses, pbar,
-                                nuc_to_codon):
-    pbar()
-
-    new_nuc_mutations_here = node.nuc_mutations
-    new_past_nuc_muts_dict = past_nuc_muts_dict.copy()
-    node.aa_muts = get_mutations(new_past_nuc_muts_dict,
-                                 new_nuc_mutations_here, seq, nuc_to_codon)
-    for child in node.children:
-        recursive_mutation_analysis(child, new_past_nuc_muts_dict, seq, cdses,
-                                    pbar, nuc_to_codon)
+def iterative_mutation_analysis(tree, seq, pbar, codon_index, mutation_table):
+    """Depth-first walk that applies each node's mutations to one shared state
+    dict on entry and rolls them back on exit, instead of copying it per node"""
+    past_nuc_muts_dict = {}
+    undo_stack = []
+    tree.aa_mutation_ids = [None] * len(tree)
+
+    def enter(node):
+        pbar()
+        new_nuc_mutations_here = [
+            mutation_table[i] for i in tree.nuc_mutation_ids[node]
+        ]
+        undo_stack.append(
+            record_undo(past_nuc_muts_dict, new_nuc_mutations_here))
+        tree.aa_mutation_ids[node] = array('I', [
+            mutation_table.intern(mutation)
+            for mutation in get_mutations(past_nuc_muts_dict,
+                                          new_nuc_mutations_here, seq,
+                                          codon_index)
+        ])
+
+    def leave(node):
+        # Leaving this node's subtree: roll back its mutations
+        roll_back(past_nuc_muts_dict, undo_stack.pop())
+
+    tree.traverse(enter, leave)
+
+
+def record_undo(past_nuc_muts_dict, new_nuc_mutations_here):
+    return [(mutation.one_indexed_position - 1,
+             past_nuc_muts_dict.get(mutation.one_indexed_position - 1))
+            for mutation in new_nuc_mutations_here]
+
+
+def roll_back(past_nuc_muts_dict, undo):
+    for position, previous in reversed(undo):
+        if previous is None:
+            # A branch may mutate a position more than once, giving it
+            # several entries that each restore the state above the branch
+            past_nuc_muts_dict.pop(position, None)
+        else:
+            past_nuc_muts_dict[position] = previous
+
+
+# Set in each worker process by init_annotation_worker
+_worker_reference = None
+
+
+def init_annotation_worker(seq, codon_index, mutations):
+    global _worker_reference
+    _worker_reference = (seq, codon_index, mutations)
+
+
+def annotate_subtrees(subtrees):
+    """Worker: annotate the AA mutations of each of a batch of subtrees.
+
+    Each subtree is (past_nuc_muts_dict, parents, counts, ids): the nucleotide
+    state above its root, then for each of its nodes in preorder the node's
+    parent (as a position in the subtree, -1 for its root) and the number of
+    its nucleotide mutation ids in ids. Returns, per subtree, each node's list
+    of AA mutations in preorder."""
+    seq, codon_index, mutations = _worker_reference
+    results = []
+    for past_nuc_muts_dict, parents, counts, ids in subtrees:
+        undo_stack = []
+        annotations = []
+        start = 0
+        for i, (parent, count) in enumerate(zip(parents, counts)):
+            while undo_stack and undo_stack[-1][0] != parent:
+                roll_back(past_nuc_muts_dict, undo_stack.pop()[1])
+            new_nuc_mutations_here = [
+                mutations[x] for x in ids[start:start + count]
+            ]
+            start += count
+            undo_stack.append(
+                (i, record_undo(past_nuc_muts_dict, new_nuc_mutations_here)))
+            annotations.append(
+                get_mutations(past_nuc_muts_dict, new_nuc_mutations_here, seq,
+                              codon_index))
+        results.append(annotations)
+    return results
+
+
+def parallel_mutation_analysis(tree, seq, pbar, codon_index, mutation_table,
+                               processes):
+    """Annotate AA mutations with a pool of worker processes.
+
+    The tree is cut into subtrees of at most 1/(4 * processes) of its nodes.
+    The nodes above them are annotated here, in the same walk that records
+    the nucleotide state above each subtree's root; the subtrees are sent to
+    the workers in batches of about that size. Mutations are then interned in
+    preorder as results come back, so ids match those of a serial run."""
+    order = array('l', tree.preorder())
+    position = array('l', [0]) * len(tree)
+    size = array('l', [1]) * len(tree)
+    for i, node in enumerate(order):
+        position[node] = i
+    for node in reversed(order):
+        if node != tree.root:
+            size[tree.parent[node]] += size[node]
+    target = max(1, -(-len(order) // (4 * processes)))
+
+    # Walk the nodes above the cut, as in iterative_mutation_analysis,
+    # skipping over each subtree once its starting state is recorded
+    past_nuc_muts_dict = {}
+    undo_stack = []
+    top_annotations = {}
+    segments = []  # (position in order, number of nodes, is a subtree)
+    batches = [[]]
+    batch_size = 0
+    i = 0
+    while i < len(order):
+        node = order[i]
+        parent = tree.parent[node] if node != tree.root else -1
+        while undo_stack and undo_stack[-1][0] != parent:
+            roll_back(past_nuc_muts_dict, undo_stack.pop()[1])
+        if size[node] <= target:
+            nodes = order[i:i + size[node]]
+            parents = array('l', [position[tree.parent[x]] - i for x in nodes])
+            parents[0] = -1
+            counts = array('l', [len(tree.nuc_mutation_ids[x]) for x in nodes])
+            ids = array('I')
+            for x in nodes:
+                ids.extend(tree.nuc_mutation_ids[x])
+            if batch_size >= target:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append((dict(past_nuc_muts_dict), parents, counts, ids))
+            batch_size += len(nodes)
+            segments.append((i, len(nodes), True))
+            i += len(nodes)
+        else:
+            new_nuc_mutations_here = [
+                mutation_table[x] for x in tree.nuc_mutation_ids[node]
+            ]
+            undo_stack.append(
+                (node, record_undo(past_nuc_muts_dict,
+                                   new_nuc_mutations_here)))
+            top_annotations[node] = get_mutations(past_nuc_muts_dict,
+                                                  new_nuc_mutations_here, seq,
+                                                  codon_index)
+            segments.append((i, 1, False))
+            i += 1
+
+    tree.aa_mutation_ids = [None] * len(tree)
+    with multiprocessing.Pool(processes,
+                              initializer=init_annotation_worker,
+                              initargs=(seq, codon_index,
+                                        mutation_table.mutations)) as pool:
+        subtree_annotations = (annotations
+                               for batch in pool.imap(annotate_subtrees,
+                                                      batches)
+                               for annotations in batch)
+        for start, length, is_subtree in segments:
+            if is_subtree:
+                annotations = next(subtree_annotations)
+            else:
+                annotations = [top_annotations.pop(order[start])]
+            for node, mutations_here in zip(order[start:start + length],
+                                            annotations):
+                pbar()
+                tree.aa_mutation_ids[node] = array(
+                    'I',
+                    [mutation_table.intern(x) for x in mutations_here])
 
 
 NUC_ENUM = "ACGT"
 
 
-def preorder_traversal(node):
-    yield node
-    for clade in node.children:
-        yield from preorder_traversal(clade)
-
-
-def preorder_traversal_internal(node):
-    yield node
-    for clade in node.children:
-        for x in preorder_traversal_internal(clade):
-            if not x.is_leaf():
-                yield x
-
-
-def preorder_traversal_iter(node):
-    return iter(preorder_traversal(node))
+UNSAFE_LABEL_CHARACTERS = set("[],:'();")
+# A bracket, comma or semicolon, or a node's label and branch length, where
+# the label may be quoted ('...', with '' for a quote) to contain the others
+NEWICK_TOKEN = re.compile(r"[(),;]|(?:[^(),;']+|'(?:[^']|'')*')+")
+QUOTED_LABEL = re.compile(r"'((?:[^']|'')*)'")
+
+
+def split_newick_token(token):
+    """Split a node's newick token into its (unquoted) label and the text of
+    its branch length"""
+    if token.startswith("'"):
+        match = QUOTED_LABEL.match(token)
+        _, _, length = token[match.end():].partition(":")
+        return match.group(1).replace("''", "'"), length.strip()
+    label, _, length = token.partition(":")
+    return label, length
+
+
+class ArrayTree:
+    """A rooted tree stored as flat arrays indexed by node number, rather than
+    one Python object per node.
+
+    Children are kept as doubly linked sibling lists (first_child, last_child,
+    next_sibling, prev_sibling), so nodes can be added, removed and reordered
+    in place. Per-node annotations (mutations, clades, coordinates) are lists
+    or arrays indexed by node number, filled in by the code that needs them.
+    Nodes removed from the tree keep their number but are no longer reached
+    by traversals from the root."""
+
+    def __init__(self):
+        self.parent = array('l')
+        self.first_child = array('l')
+        self.last_child = array('l')
+        self.next_sibling = array('l')
+        self.prev_sibling = array('l')
+        self.label = []
+        self.edge_length = array('d')
+        self.root = 0
+        self.nuc_mutation_ids = []
+        self.aa_mutation_ids = None
+        self.clades = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent=-1, label=None, edge_length=0.0):
+        node = len(self.parent)
+        self.parent.append(-1)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.prev_sibling.append(-1)
+        self.label.append(label)
+        self.edge_length.append(edge_length)
+        if parent >= 0:
+            self.add_child(parent, node)
+        return node
+
+    def add_child(self, parent, child):
+        last = self.last_child[parent]
+        self.parent[child] = parent
+        self.prev_sibling[child] = last
+        self.next_sibling[child] = -1
+        if last < 0:
+            self.first_child[parent] = child
+        else:
+            self.next_sibling[last] = child
+        self.last_child[parent] = child
+
+    def remove_child(self, parent, child):
+        if parent < 0 or self.parent[child] != parent:
+            raise RuntimeError("Attempting to remove non-existent child")
+        before = self.prev_sibling[child]
+        after = self.next_sibling[child]
+        if before < 0:
+            self.first_child[parent] = after
+        else:
+            self.next_sibling[before] = after
+        if after < 0:
+            self.last_child[parent] = before
+        else:
+            self.prev_sibling[after] = before
+        self.parent[child] = -1
+        self.prev_sibling[child] = -1
+        self.next_sibling[child] = -1
+
+    def set_children(self, parent, children):
+        """Relink parent's children in the given order"""
+        prev = -1
+        for child in children:
+            self.prev_sibling[child] = prev
+            if prev >= 0:
+                self.next_sibling[prev] = child
+            prev = child
+        self.next_sibling[prev] = -1
+        self.first_child[parent] = children[0]
+        self.last_child[parent] = prev
+
+    def is_leaf(self, node):
+        return self.first_child[node] < 0
+
+    def children(self, node, reverse=False):
+        step = self.prev_sibling if reverse else self.next_sibling
+        child = self.last_child[node] if reverse else self.first_child[node]
+        while child >= 0:
+            yield child
+            child = step[child]
+
+    def preorder(self, reverse=False):
+        """Yield the nodes in preorder, visiting children first to last, or
+        last to first if reverse is set (the order treeswift's traversals use)"""
+        down = self.last_child if reverse else self.first_child
+        across = self.prev_sibling if reverse else self.next_sibling
+        root = self.root
+        node = root
+        while True:
+            yield node
+            if down[node] >= 0:
+                node = down[node]
+                continue
+            while node != root and across[node] < 0:
+                node = self.parent[node]
+            if node == root:
+                return
+            node = across[node]
+
+    def postorder(self):
+        first_child = self.first_child
+        root = self.root
+        node = root
+        while first_child[node] >= 0:
+            node = first_child[node]
+        while True:
+            yield node
+            if node == root:
+                return
+            if self.next_sibling[node] >= 0:
+                node = self.next_sibling[node]
+                while first_child[node] >= 0:
+                    node = first_child[node]
+            else:
+                node = self.parent[node]
+
+    def leaves(self, reverse=False):
+        for node in self.preorder(reverse):
+            if self.first_child[node] < 0:
+                yield node
+
+    def num_nodes(self):
+        return sum(1 for _ in self.preorder())
+
+    def traverse(self, enter=None, leave=None):
+        """Walk the tree once depth-first, calling enter(node) before any of
+        node's descendants and leave(node) after all of them, so per-node work
+        that needs preorder and work that needs postorder can share one walk.
+        leave(node) may change node's own children."""
+        root = self.root
+        node = root
+        while True:
+            if enter is not None:
+                enter(node)
+            if self.first_child[node] >= 0:
+                node = self.first_child[node]
+                continue
+            while True:
+                if leave is not None:
+                    leave(node)
+                if node == root:
+                    return
+                if self.next_sibling[node] >= 0:
+                    node = self.next_sibling[node]
+                    break
+                node = self.parent[node]
+
+    def read_newick(self, newick, name_internal_nodes=False,
+                    branch_lengths=True):
+        """Add the nodes of a newick string to this (empty) tree, yielding each
+        node's number as it is created. Nodes are created in preorder, so the
+        i-th node yielded is the i-th node of a preorder traversal, and callers
+        can attach per-node data in the same pass. Missing branch lengths are
+        read as 0, and all are left at 0 for the caller to set if
+        branch_lengths is False. Internal nodes without a label are named
+        node_1, node_2, ... in preorder if name_internal_nodes is set. Quoted
+        labels ('...', with '' for a quote) are unquoted."""
+        newick = newick.strip()
+        if newick.startswith("["):
+            newick = newick[newick.index("]") + 1:]
+        stack = []
+        closed = -1
+        expecting_node = True
+        internal_count = 0
+        for token in NEWICK_TOKEN.findall(newick):
+            token = token.strip()
+            if token == "(":
+                internal_count += 1
+                node = self.add_node(
+                    stack[-1] if stack else -1, "node_" +
+                    str(internal_count) if name_internal_nodes else None)
+                yield node
+                stack.append(node)
+            elif token in (",", ")", ";"):
+                if expecting_node and token != ";":
+                    # A leaf with neither a label nor a branch length
+                    yield self.add_node(stack[-1])
+                closed = stack.pop() if token == ")" else -1
+                expecting_node = token == ","
+            elif token:
+                label, length = split_newick_token(token)
+                length = float(length) if length and branch_lengths else 0.0
+                if expecting_node:
+                    yield self.add_node(stack[-1] if stack else -1, label
+                                        or None, length)
+                    expecting_node = False
+                elif closed >= 0:
+                    # A label after a closing bracket belongs to that node
+                    if label:
+                        self.label[closed] = label
+                    if branch_lengths:
+                        self.edge_length[closed] = length
+                    closed = -1
+
+    def newick(self):
+        """Write the tree as a newick string, formatted as treeswift does.
+        Labels with unsafe characters are quoted, with quotes in them doubled,
+        so read_newick reads the string back into the same tree."""
+
+        def label_and_length(node):
+            label = self.label[node]
+            if label is None:
+                label = ""
+            elif any(c in UNSAFE_LABEL_CHARACTERS for c in label):
+                label = "'" + label.replace("'", "''") + "'"
+            length = self.edge_length[node]
+            if length.is_integer():
+                length = int(length)
+            return f"{label}:{length}"
+
+        parts = []
+        root = self.root
+        node = root
+        while True:
+            if self.first_child[node] >= 0:
+                parts.append("(")
+                node = self.first_child[node]
+                continue
+            parts.append(label_and_length(node))
+            while node != root and self.next_sibling[node] < 0:
+                node = self.parent[node]
+                parts.append(")" + label_and_length(node))
+            if node == root:
+                break
+            parts.append(",")
+            node = self.next_sibling[node]
+        parts.append(";")
+        return "".join(parts)
+
+    def ladderize(self, ascending=True):
+        """Sort each node's children by number of descendants, then branch
+        length, then label, as treeswift's Tree.ladderize does"""
+        num_descendants = array('l', [0]) * len(self.parent)
+        for node in self.postorder():
+            parent = self.parent[node]
+            if node != self.root and parent >= 0:
+                num_descendants[parent] += num_descendants[node] + 1
+        label = self.label
+        edge_length = self.edge_length
+        for node in self.preorder():
+            if self.first_child[node] != self.last_child[node]:
+                self.set_children(
+                    node,
+                    sorted(self.children(node),
+                           key=lambda x: (num_descendants[x], edge_length[x],
+                                          label[x] is not None, label[x]),
+                           reverse=not ascending))
 
 
 def find_cds(position, cdses):
@@ -221,74 +834,140 @@ class UsherMutationAnnotatedTree:
                  name_internal_nodes=False,
                  clade_types=[],
                  shear=False,
-                 shear_threshold=1000):
-        self.data = parsimony_pb2.data()
-        self.data.ParseFromString(tree_file.read())
-        self.condensed_nodes_dict = self.get_condensed_nodes_dict(
-            self.data.condensed_nodes)
+                 shear_threshold=1000,
+                 processes=1):
+        self.mutation_table = MutationTable()
+        self.processes = processes
         print("Loading tree, this may take a while...")
-        self.tree = treeswift.read_tree(self.data.newick, schema="newick")
-        if name_internal_nodes:
-            self.name_internal_nodes()
-        self.data.newick = ''
-
-        self.annotate_mutations()
-        self.annotate_clades(clade_types)
-
-        self.expand_condensed_nodes()
-        self.assign_num_tips()
-        print(f"Loaded initial tree with {self.tree.root.num_tips} tips")
-        print("Ending early")
+        if isinstance(tree_file, parsimony_pb2.data):
+            mat_stream = protobuf_stream.MATMessage(tree_file)
+        else:
+            mat_stream = protobuf_stream.MATStream(
+                tree_file, keep_metadata=bool(clade_types))
+        self.load_tree(mat_stream, clade_types, name_internal_nodes)
+
+        self.tree.num_tips = array('l', [1]) * len(self.tree)
+        self.root_parent_nucs = {}
+        steps = [self.expand_condensed_children, self.count_tips]
         if genbank_file:
             # We need to reconstruct root seq before shearing as shearing can mess it up
-
+            steps.append(self.collect_root_parent_nucs)
+        self.run_postorder_steps(steps,
+                                 "Expanding condensed nodes and counting tips",
+                                 total=len(self.tree))
+        print(
+            f"Loaded initial tree with {self.tree.num_tips[self.tree.root]} tips"
+        )
+        print("Ending early")
+        if genbank_file:
             self.load_genbank_file(genbank_file)
             self.get_root_sequence()
         if shear:
             print("Shearing tree...")
             self.shear_tree(shear_threshold)
-        self.assign_num_tips()
-        print(f"Tree to use now has {self.tree.root.num_tips} tips")
-        self.set_branch_lengths()
+            self.run_postorder_steps([self.count_tips, self.set_branch_length],
+                                     "Recounting tips")
+        print(
+            f"Tree to use now has {self.tree.num_tips[self.tree.root]} tips")
         if genbank_file:
             self.perform_aa_analysis()
 
+    def load_tree(self, mat_stream, clade_types, name_internal_nodes):
+        """Build the array tree from the protobuf stream. Nodes are created in
+        preorder, the order of node_mutations and metadata in the protobuf, so
+        each node's mutations are decoded and attached as it is created, and
+        clades are then attached by node number."""
+        self.tree = ArrayTree()
+        node_mutations = mat_stream.node_mutations()
+        with alive_bar(title="Loading tree") as bar:
+            # Branch lengths are the number of mutations on each branch
+            for i in self.tree.read_newick(mat_stream.newick(),
+                                           name_internal_nodes,
+                                           branch_lengths=False):
+                mutation_list = next(node_mutations, None)
+                if mutation_list is None:
+                    raise ValueError(
+                        "The protobuf has fewer node_mutations than tree nodes"
+                    )
+                self.tree.nuc_mutation_ids.append(
+                    array('I', [
+                        self.convert_nuc_mutation(x)
+                        for x in mutation_list.mutation
+                    ]))
+                self.tree.edge_length[i] = len(mutation_list.mutation)
+                bar()
+        if clade_types:
+            self.tree.clades = [None] * len(self.tree)
+            with alive_bar(len(self.tree), title="Annotating clades") as bar:
+                for i, this_thing in zip(range(len(self.tree)),
+                                         mat_stream.metadata()):
+                    self.tree.clades[i] = {
+                        clade_types[index]: part
+                        for index, part in enumerate(
+                            this_thing.clade_annotations)
+                    }
+                    bar()
+            if self.tree.clades[-1] is None:
+                raise ValueError(
+                    "The protobuf has fewer metadata entries than tree nodes")
+        self.condensed_nodes_dict = mat_stream.condensed_nodes()
+
+    def run_postorder_steps(self, steps, title, total=None):
+        """Run each of steps on every node in a single postorder walk, so that
+        per-node work which only needs postorder does not take a pass each"""
+        with alive_bar(total, title=title) as bar:
+
+            def leave(node):
+                for step in steps:
+                    step(node)
+                bar()
+
+            self.tree.traverse(leave=leave)
+
     def prune_node(self, node_to_prune):
         """Remove node from parent, then check if parent has zero descendants. If so remove it.
         If parent has a single descendant, then give the parent's mutations to the descendant, unless they
         conflict with the descendants own mutations. Also give the parent's clade annotations to the descendant,
         unless they conflict. Then prune the parent, and instead add this child to parent's parent."""
-        parent = node_to_prune.parent
-        parent.remove_child(node_to_prune)
-        if len(parent.children) == 0:
+        tree = self.tree
+        parent = tree.parent[node_to_prune]
+        tree.remove_child(parent, node_to_prune)
+        if tree.is_leaf(parent):
             self.prune_node(parent)
-        elif len(parent.children) == 1:
-            child = parent.children[0]
-            for mutation in parent.nuc_mutations:
-                if mutation.one_indexed_position not in [
-                        x.one_indexed_position for x in child.nuc_mutations
-                ]:
-                    child.nuc_mutations.append(mutation)
-            if hasattr(parent, "clades"):
-                for clade_type, clade_annotation in parent.clades.items():
-                    if clade_type not in child.clades or child.clades[
+        elif tree.first_child[parent] == tree.last_child[parent]:
+            child = tree.first_child[parent]
+            child_positions = [
+                self.mutation_table[i].one_indexed_position
+                for i in tree.nuc_mutation_ids[child]
+            ]
+            for i in tree.nuc_mutation_ids[parent]:
+                if self.mutation_table[
+                        i].one_indexed_position not in child_positions:
+                    tree.nuc_mutation_ids[child].append(i)
+            if tree.clades is not None:
+                child_clades = tree.clades[child]
+                for clade_type, clade_annotation in tree.clades[parent].items(
+                ):
+                    if clade_type not in child_clades or child_clades[
                             clade_type] == "":
-                        child.clades[clade_type] = clade_annotation
-            grandparent = parent.parent
-            parent.remove_child(child)
-            if grandparent:
-                grandparent.remove_child(parent)
-                grandparent.add_child(child)
+                        child_clades[clade_type] = clade_annotation
+            grandparent = tree.parent[parent]
+            tree.remove_child(parent, child)
+            if grandparent >= 0:
+                tree.remove_child(grandparent, parent)
+                tree.add_child(grandparent, child)
 
     def shear_tree(self, theshold=1000):
         """Consider each node. If at any point a child has fewer than 1/threshold proportion of the num_tips, then prune it"""
-        for node in alive_it(list(self.tree.traverse_postorder())):
+        num_tips = self.tree.num_tips
+        for node in alive_it(array('l', self.tree.postorder())):
             if (node == self.tree.root):
                 continue
-            if len(node.children) > 1:
-                biggest_child = max(node.children, key=lambda x: x.num_tips)
-                for child in list(node.children):
-                    if biggest_child.num_tips / child.num_tips > theshold:
+            children = list(self.tree.children(node))
+            if len(children) > 1:
+                biggest_child = max(children, key=lambda x: num_tips[x])
+                for child in children:
+                    if num_tips[biggest_child] / num_tips[child] > theshold:
                         self.prune_node(child)
 
     def create_mutation_like_objects_to_record_root_seq(self):
@@ -302,152 +981,90 @@ class UsherMutationAnnotatedTree:
 
         return ref_muts
 
-    def annotate_clades(self, clade_types):
-        if clade_types:
-            for i, node in alive_it(list(
-                    enumerate(preorder_traversal(self.tree.root))),
-                                    title="Annotating clades"):
-
-                this_thing = self.data.metadata[i]
-                node.clades = {
-                    clade_types[index]: part
-                    for index, part in enumerate(this_thing.clade_annotations)
-                }
-
     def perform_aa_analysis(self):
 
-        seq = str(self.genbank.seq)
+        seq = self.reference_sequence
         with alive_bar(self.tree.num_nodes(),
                        title="Annotating amino acids") as pbar:
-            recursive_mutation_analysis(self.tree.root, {}, seq, self.cdses,
-                                        pbar, self.nuc_to_codon)
+            if self.processes > 1:
+                parallel_mutation_analysis(self.tree, seq, pbar,
+                                           self.codon_index,
+                                           self.mutation_table,
+                                           self.processes)
+            else:
+                iterative_mutation_analysis(self.tree, seq, pbar,
+                                            self.codon_index,
+                                            self.mutation_table)
         root_muts = self.create_mutation_like_objects_to_record_root_seq()
-        self.tree.root.aa_muts = get_mutations(
-            {},
-            root_muts,
-            seq,
-            self.nuc_to_codon,
-            disable_check_for_differences=True)
-        self.tree.root.nuc_mutations = root_muts
+        root = self.tree.root
+        self.tree.aa_mutation_ids[root] = array('I', [
+            self.mutation_table.intern(mutation)
+            for mutation in get_mutations({},
+                                          root_muts,
+                                          seq,
+                                          self.codon_index,
+                                          disable_check_for_differences=True)
+        ])
+        self.tree.nuc_mutation_ids[root] = array(
+            'I', [self.mutation_table.intern(x) for x in root_muts])
 
     def load_genbank_file(self, genbank_file):
-        self.genbank = SeqIO.read(genbank_file, "genbank")
-        self.cdses = [x for x in self.genbank.features if x.type == "CDS"]
-        # Assert that there are no compound locations and that all strands are positive,
-        # and that all CDS features are a multiple of 3
-
-        self.genes = get_genes_dict(self.cdses)
-
-        by_everything = defaultdict(lambda: defaultdict(dict))
-        total_lengths = {}
-
-        for feature in self.cdses:
-
-            gene_name = get_gene_name(feature)
-
-            nucleotide_counter = 0
-            for part in feature.location.parts:
-                ranger = range(
-                    part.start, part.end
-                ) if part.strand == 1 else range(
-                    part.end - 1, part.start - 1, -1
-                )  #(honestly not sure why we need to subtract 1 here but we seem to?)
-
-                for genome_position in ranger:
-
-                    cur_codon_number = nucleotide_counter // 3
-                    cur_pos_in_codon = nucleotide_counter % 3
-
-                    by_everything[gene_name][cur_codon_number][
-                        cur_pos_in_codon] = genome_position
-                    nucleotide_counter += 1
-            total_lengths[gene_name] = nucleotide_counter
-
-        nuc_to_codon = defaultdict(list)
-
-        for feat_name, codons in by_everything.items():
-            for codon_index, codon_dict in codons.items():
-                codon_obj = Codon(feat_name, codon_index, codon_dict,
-                                  self.genes[feat_name].strand)
-
-                assert len(codon_dict) % 3 == 0
-                for k, v in codon_dict.items():
-                    nuc_to_codon[v].append(codon_obj)
-
-        self.nuc_to_codon = nuc_to_codon
+        self.reference_sequence, self.genes, self.codon_index = load_reference(
+            genbank_file)
 
     def convert_nuc_mutation(self, usher_mutation):
-        new_mut = NucMutation(one_indexed_position=usher_mutation.position,
-                              par_nuc=NUC_ENUM[usher_mutation.par_nuc],
-                              mut_nuc=NUC_ENUM[usher_mutation.mut_nuc[0]])
-        return new_mut
-
-    def annotate_mutations(self):
-        for i, node in alive_it(list(
-                enumerate(preorder_traversal(self.tree.root))),
-                                title="Annotating nuc muts"):
-            node.nuc_mutations = [
-                self.convert_nuc_mutation(x)
-                for x in self.data.node_mutations[i].mutation
-            ]
+        return self.mutation_table.intern_nuc(
+            usher_mutation.position, NUC_ENUM[usher_mutation.par_nuc],
+            NUC_ENUM[usher_mutation.mut_nuc[0]])
+
+    def collect_root_parent_nucs(self, node):
+        """Record the parental nucleotide of each of node's mutations. In
+        postorder, ancestors overwrite their descendants' entries."""
+        if node == self.tree.root:
+            return
+        for i in self.tree.nuc_mutation_ids[node]:
+            mutation = self.mutation_table[i]
+            self.root_parent_nucs[
+                mutation.one_indexed_position] = mutation.par_nuc
 
     def get_root_sequence(self):
-        collected_mutations = {}
-        for i, node in alive_it(list(
-                enumerate(self.tree.root.traverse_postorder())),
-                                title="Getting root sequence"):
-            if node == self.tree.root:
-                continue
-            for mutation in node.nuc_mutations:
-                collected_mutations[
-                    mutation.one_indexed_position] = mutation.par_nuc
-        self.root_sequence = list(str(self.genbank.seq))
+        collected_mutations = self.root_parent_nucs
+        self.root_sequence = list(self.reference_sequence)
         for i, character in enumerate(self.root_sequence):
             if i + 1 in collected_mutations:
                 self.root_sequence[i] = collected_mutations[i + 1]
         self.root_sequence = "".join(self.root_sequence)
-
-    def name_internal_nodes(self):
-        for i, node in alive_it(list(
-                enumerate(preorder_traversal_internal(self.tree.root))),
-                                title="Naming internal nodes"):
-            if not node.label:
-                node.label = "node_" + str(i + 1)
-
-    def set_branch_lengths(self):
-        for node in alive_it(list(preorder_traversal(self.tree.root)),
-                             title="Setting branch length"):
-            node.edge_length = len(node.nuc_mutations)
-
-    def expand_condensed_nodes(self):
-        for node in alive_it(list(self.tree.traverse_leaves()),
-                             title="Expanding condensed nodes"):
-
-            if node.label and node.label in self.condensed_nodes_dict:
-                assert len(node.nuc_mutations) == 0
-
-                for new_node_label in self.condensed_nodes_dict[node.label]:
-                    new_node = treeswift.Node(label=new_node_label)
-                    new_node.nuc_mutations = node.nuc_mutations
-                    if hasattr(node, "clades"):
-                        new_node.clades = node.clades
-                    node.parent.add_child(new_node)
-                node.label = ""
-                node.parent.remove_child(node)
-            else:
-                pass
-
-    def get_condensed_nodes_dict(self, condensed_nodes_dict):
-        output_dict = {}
-        for condensed_node in alive_it(condensed_nodes_dict,
-                                       title="Reading condensed nodes dict"):
-            output_dict[
-                condensed_node.node_name] = condensed_node.condensed_leaves
-        return output_dict
-
-    def assign_num_tips(self):
-        for node in self.tree.traverse_postorder():
-            if node.is_leaf():
-                node.num_tips = 1
-            else:
-                node.num_tips = sum(child.num_tips for child in node.children)
+        self.root_parent_nucs = {}
+
+    def set_branch_length(self, node):
+        self.tree.edge_length[node] = len(self.tree.nuc_mutation_ids[node])
+
+    def expand_condensed_children(self, node):
+        """Replace the condensed leaves among node's children by their samples.
+        Children are handled last to first, the order treeswift traversed leaves in."""
+        tree = self.tree
+        child = tree.last_child[node]
+        while child >= 0:
+            previous = tree.prev_sibling[child]
+            label = tree.label[child]
+            if tree.is_leaf(
+                    child) and label and label in self.condensed_nodes_dict:
+                assert len(tree.nuc_mutation_ids[child]) == 0
+
+                for new_node_label in self.condensed_nodes_dict[label]:
+                    tree.add_node(node, new_node_label)
+                    tree.nuc_mutation_ids.append(tree.nuc_mutation_ids[child])
+                    tree.num_tips.append(1)
+                    if tree.clades is not None:
+                        tree.clades.append(tree.clades[child])
+                tree.label[child] = ""
+                tree.remove_child(node, child)
+            child = previous
+
+    def count_tips(self, node):
+        tree = self.tree
+        if tree.is_leaf(node):
+            tree.num_tips[node] = 1
+        else:
+            tree.num_tips[node] = sum(tree.num_tips[child]
+                                      for child in tree.children(node))
@@ -2,8 +2,8 @@ from alive_progress import alive_it, alive_bar
 import pandas as pd
 import warnings
 import os, tempfile, sys, errno
-import treeswift
 import shutil
+from array import array
 from . import ushertools
 
 
@@ -19,10 +19,13 @@ def read_metadata(metadata_file, columns, key_column):
         #Disable warnings because of DTypeWarning in pandas
 
         warnings.filterwarnings("ignore")
-        metadata = pd.read_csv(metadata_file,
-                               sep="\t" if metadata_file.endswith(".tsv")
-                               or metadata_file.endswith(".tsv.gz") else ",",
-                               usecols=cols_of_interest)
+        if hasattr(metadata_file, "read"):
+            # Already-open (e.g. in-memory) metadata is tab-separated
+            sep = "\t"
+        else:
+            sep = "\t" if metadata_file.endswith(".tsv") or metadata_file.endswith(
+                ".tsv.gz") else ","
+        metadata = pd.read_csv(metadata_file, sep=sep, usecols=cols_of_interest)
         # Enable again
         warnings.filterwarnings("default")
         metadata[key_column] = metadata[key_column].astype(str)
@@ -58,8 +61,8 @@ def do_chronumental(mat, chronumental_reference_node, metadata_file,
         print("#####  Exiting.  #####")
         sys.exit(1)
     with tempfile.TemporaryDirectory() as tmpdirname:
-        mat.tree.write_tree_newick(
-            os.path.join(tmpdirname, "distance_tree.nwk"))
+        with open(os.path.join(tmpdirname, "distance_tree.nwk"), "w") as f:
+            f.write(mat.tree.newick())
 
         print("Launching chronumental")
 
@@ -78,21 +81,19 @@ def do_chronumental(mat, chronumental_reference_node, metadata_file,
         # %%
 
         print("Reading time tree")
-        time_tree = treeswift.read_tree(os.path.join(tmpdirname,
-                                                     "timetree.nwk"),
-                                        schema="newick")
+        time_tree = ushertools.ArrayTree()
+        with open(os.path.join(tmpdirname, "timetree.nwk")) as f:
+            for node in time_tree.read_newick(f.read()):
+                pass
         if chronumental_tree_output:
             shutil.copy2(os.path.join(tmpdirname, "timetree.nwk"),
                          chronumental_tree_output)
-        time_tree_iter = ushertools.preorder_traversal(time_tree.root)
-        for i, node in alive_it(enumerate(
-                ushertools.preorder_traversal(mat.tree.root)),
-                                title="Adding time tree"):
-            time_tree_node = next(time_tree_iter)
-
-            node.time_length = time_tree_node.edge_length
+        mat.tree.time_length = array('d', [0.0]) * len(mat.tree)
+        for node, time_tree_node in alive_it(zip(mat.tree.preorder(),
+                                                 time_tree.preorder()),
+                                             title="Adding time tree"):
+            mat.tree.time_length[node] = time_tree.edge_length[time_tree_node]
         del time_tree
-        del time_tree_iter
 
         if chronumental_add_inferred_date:
             print(
@@ -173,22 +174,60 @@ def set_internal_y_coords(root):
         node.y = (min(child_ys) + max(child_ys)) / 2
 
 
-def get_all_aa_muts(root):
-    all_aa_muts = set()
-    for node in alive_it(list(root.traverse_preorder()),
-                         title="Collecting all AA mutations"):
-        if hasattr(node, 'aa_muts'):
-            all_aa_muts.update(node.aa_muts)
-    return list(all_aa_muts)
+def set_array_x_coords(tree, chronumental_enabled):
+    """ Set x coordinates for an ArrayTree"""
+    order = array('l', tree.preorder())
+    tree.x_dist = array('d', [0.0]) * len(tree)
+    tree.x_time = array('d', [0.0]) * len(tree)
+    for node in alive_it(order, title="Setting x coordinates"):
+        parent = tree.parent[node]
+        if parent >= 0:
+            tree.x_dist[node] = tree.x_dist[parent] + tree.edge_length[node]
+            if chronumental_enabled:
+                tree.x_time[node] = tree.x_time[parent] + tree.time_length[
+                    node]
 
+    normalise_array_x_coords(order, tree.x_dist, fixed_val=600)
+    if chronumental_enabled:
+        normalise_array_x_coords(order, tree.x_time, fixed_val=600)
 
-def get_all_nuc_muts(root):
-    all_nuc_muts = set()
-    for node in alive_it(list(root.traverse_preorder()),
-                         title="Collecting all nuc mutations"):
-        if node.nuc_mutations:
-            all_nuc_muts.update(node.nuc_mutations)
-    return list(all_nuc_muts)
+
+def normalise_array_x_coords(order, x_coords, fixed_val=75):
+    """Find the 95th percentile of the x-coordinates of the nodes in order, and normalise it to be the fixed val"""
+    sorted_x_coords = sorted(x_coords[node] for node in order)
+    percentile_95 = sorted_x_coords[int(len(sorted_x_coords) * 0.95)]
+    for node in alive_it(order, title="Normalising x coordinates"):
+        x_coords[node] = fixed_val * (x_coords[node] / percentile_95)
+
+
+def set_array_terminal_y_coords(tree):
+    tree.y = array('d', [0.0]) * len(tree)
+    # Leaves are numbered last to first, the order treeswift's traversals use
+    for i, node in alive_it(enumerate(tree.leaves(reverse=True)),
+                            title="Setting terminal y coordinates"):
+        tree.y[node] = i
+
+
+def set_array_internal_y_coords(tree):
+    # Each node should be halfway between the min and max y of its children
+    y = tree.y
+    for node in alive_it(tree.postorder(),
+                         title="Setting internal y coordinates"):
+        if not tree.is_leaf(node):
+            child_ys = [y[child] for child in tree.children(node)]
+            y[node] = (min(child_ys) + max(child_ys)) / 2
+
+
+def get_used_mutation_ids(tree, num_mutations):
+    """Return the indices into the mutation table used by any node, in table order"""
+    used = bytearray(num_mutations)
+    for node in alive_it(tree.preorder(), title="Collecting all mutations"):
+        if tree.aa_mutation_ids is not None:
+            for i in tree.aa_mutation_ids[node]:
+                used[i] = 1
+        for i in tree.nuc_mutation_ids[node]:
+            used[i] = 1
+    return [i for i in range(num_mutations) if used[i]]
 
 
 def make_aa_object(i, aa_mutation):
@@ -276,3 +315,66 @@ def sort_on_y(tree):
         nodes_sorted_by_y = sorted(tree.root.traverse_preorder(),
                                    key=lambda x: return_y(x))
     return nodes_sorted_by_y
+
+
+def get_array_node_object(tree, node, node_to_index, metadata, input_to_index,
+                          columns, chronumental_enabled):
+
+    object = {}
+    label = tree.label[node]
+    is_tip = tree.is_leaf(node)
+    object["name"] = label if label else ""
+    # round to 5 dp
+    object["x_dist"] = round(tree.x_dist[node], 5)
+    if chronumental_enabled:
+        object["x_time"] = round(tree.x_time[node], 5)
+    # Tips are numbered with integers, internal nodes lie halfway between
+    object["y"] = int(tree.y[node]) if is_tip else tree.y[node]
+    object['mutations'] = []
+    if tree.aa_mutation_ids is not None:
+        object['mutations'] += [
+            input_to_index[i] for i in tree.aa_mutation_ids[node]
+        ]
+    object['mutations'] += [
+        input_to_index[i] for i in tree.nuc_mutation_ids[node]
+    ]
+    object['is_tip'] = is_tip
+
+    # check if label is in metadata's index
+    try:
+        my_dict = metadata[label]
+        for key in my_dict:
+            value = my_dict[key]
+            #if value is pd.NaN then set to empty string
+            if pd.isna(value):
+                value = ""
+            object["meta_" + key] = value
+    except KeyError:
+        for key in columns:
+            object["meta_" + key] = ""
+
+    parent = tree.parent[node]
+    object['parent_id'] = node_to_index[
+        parent] if parent >= 0 else node_to_index[node]
+    object['node_id'] = node_to_index[
+        node]  # We don't strictly need this, but it doesn't add much to the space
+
+    object['num_tips'] = tree.num_tips[node]
+
+    if tree.clades is not None:
+        object['clades'] = tree.clades[node]
+
+    return object
+
+
+def sort_array_on_y(tree):
+    with alive_bar(title="Sorting on y") as bar:
+
+        def return_y(node):
+            bar()
+            return tree.y[node]
+
+        # Ties keep the preorder treeswift's traversals use
+        nodes_sorted_by_y = array(
+            'l', sorted(tree.preorder(reverse=True), key=return_y))
+    return nodes_sorted_by_y
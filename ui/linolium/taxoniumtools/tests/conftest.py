@@ -0,0 +1,38 @@
+import os
+import random
+
+import pytest
+
+from taxoniumtools import parsimony_pb2
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                         "test_data")
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # Keep codon index caches out of the user's cache directory
+    path = tmp_path / "cache"
+    monkeypatch.setenv("TAXONIUMTOOLS_CACHE_DIR", str(path))
+    return path
+
+
+def random_tree_data(seed, leaves, positions):
+    """A parsed protobuf with a random tree of samples s1..sN and zero to three
+    random mutations on each branch, at positions drawn from positions"""
+    rng = random.Random(seed)
+    clades = [f"s{i}" for i in range(1, leaves + 1)]
+    while len(clades) > 1:
+        picked = rng.sample(clades, min(len(clades), rng.choice([2, 2, 3])))
+        clades = [c for c in clades if c not in picked]
+        clades.append("(" + ",".join(picked) + ")")
+    data = parsimony_pb2.data()
+    data.newick = clades[0] + ";"
+    for i in range(data.newick.count(",") + data.newick.count("(") + 1):
+        mutation_list = data.node_mutations.add()
+        for _ in range(rng.choice([0, 1, 1, 2, 3]) if i > 0 else 0):
+            m = mutation_list.mutation.add()
+            m.position = rng.choice(positions)
+            m.par_nuc = 0
+            m.mut_nuc.append(rng.randrange(4))
+    return data
@@ -0,0 +1,58 @@
+import os
+import pickle
+
+import numpy as np
+
+from taxoniumtools.ushertools import load_reference
+
+from conftest import TEST_DATA
+
+GENBANK_FILE = os.path.join(TEST_DATA, "hu1.gb")
+
+
+def assert_same_index(a, b):
+    assert a.gene_names == b.gene_names
+    for name in [
+            "codon_gene", "codon_number", "codon_positions", "codon_strand",
+            "offsets", "rows"
+    ]:
+        assert getattr(a, name).dtype == getattr(b, name).dtype
+        np.testing.assert_array_equal(getattr(a, name), getattr(b, name))
+    assert [list(a.codons_at(p)) for p in range(a.genome_length)
+            ] == [list(b.codons_at(p)) for p in range(b.genome_length)]
+
+
+def test_cache_round_trip(cache_dir, capsys):
+    seq, genes, codon_index = load_reference(GENBANK_FILE)
+    assert len(list(cache_dir.glob("codon_index_v*.npz"))) == 1
+    assert "from cache" not in capsys.readouterr().out
+    cached_seq, cached_genes, cached_index = load_reference(GENBANK_FILE)
+    assert "Loaded codon index from cache" in capsys.readouterr().out
+    assert cached_seq == seq
+    assert cached_genes == genes
+    assert_same_index(cached_index, codon_index)
+
+
+def test_unreadable_cache_is_rebuilt(cache_dir, capsys):
+    seq, genes, codon_index = load_reference(GENBANK_FILE)
+    (cache_file, ) = cache_dir.glob("codon_index_v*.npz")
+    cache_file.write_bytes(b"not an npz file")
+    rebuilt_seq, _, rebuilt_index = load_reference(GENBANK_FILE)
+    assert "Could not read cached codon index" in capsys.readouterr().out
+    assert rebuilt_seq == seq
+    assert_same_index(rebuilt_index, codon_index)
+    # The rebuilt index replaces the unreadable cache
+    load_reference(GENBANK_FILE)
+    assert "Loaded codon index from cache" in capsys.readouterr().out
+
+
+def test_open_file_is_not_cached(cache_dir):
+    with open(GENBANK_FILE) as f:
+        load_reference(f)
+    assert not cache_dir.exists() or not list(cache_dir.iterdir())
+
+
+def test_pickle_round_trip():
+    # Worker processes are sent the index by pickling
+    _, _, codon_index = load_reference(GENBANK_FILE)
+    assert_same_index(pickle.loads(pickle.dumps(codon_index)), codon_index)
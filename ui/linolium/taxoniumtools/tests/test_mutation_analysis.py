@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from taxoniumtools.ushertools import (UsherMutationAnnotatedTree,
+                                      get_mutations,
+                                      iterative_mutation_analysis,
+                                      load_reference)
+
+from conftest import TEST_DATA, random_tree_data
+
+
+def copied_state_annotations(tree, seq, codon_index, mutation_table):
+    """Each node's AA mutations, copying the nucleotide state for every node as
+    the recursive analysis did"""
+    states = {}
+    annotations = [None] * len(tree)
+    for node in tree.preorder():
+        state = {} if node == tree.root else states[tree.parent[node]].copy()
+        annotations[node] = get_mutations(
+            state, [mutation_table[i] for i in tree.nuc_mutation_ids[node]],
+            seq, codon_index)
+        states[node] = state
+    return annotations
+
+
+def check_iterative_analysis(mat):
+    seq, _, codon_index = load_reference(os.path.join(TEST_DATA, "hu1.gb"))
+    expected = copied_state_annotations(mat.tree, seq, codon_index,
+                                        mat.mutation_table)
+    iterative_mutation_analysis(mat.tree, seq, lambda: None, codon_index,
+                                mat.mutation_table)
+    # Condensed nodes are detached once expanded, so only compare the tree's
+    nodes = list(mat.tree.preorder())
+    assert [[mat.mutation_table[i] for i in mat.tree.aa_mutation_ids[node]]
+            for node in nodes] == [expected[node] for node in nodes]
+    assert sum(len(expected[node]) for node in nodes) > 0
+
+
+def test_iterative_analysis_of_test_tree():
+    with open(os.path.join(TEST_DATA, "tfci.pb"), "rb") as f:
+        mat = UsherMutationAnnotatedTree(f)
+    check_iterative_analysis(mat)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_iterative_analysis_with_repeat_mutations(seed):
+    # Few positions, so codons are hit again below earlier mutations and
+    # mutated back. 13468 is where ORF1a and ORF1b overlap.
+    positions = list(range(21563, 21575)) + list(range(13465, 13472))
+    check_iterative_analysis(
+        UsherMutationAnnotatedTree(random_tree_data(seed, 60, positions)))
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from taxoniumtools.usher_to_taxonium import do_processing
+from taxoniumtools.ushertools import (UsherMutationAnnotatedTree,
+                                      iterative_mutation_analysis,
+                                      load_reference,
+                                      parallel_mutation_analysis)
+
+from conftest import TEST_DATA, random_tree_data
+
+
+@pytest.mark.parametrize("processes", [2, 3])
+def test_parallel_output_is_identical(tmp_path, processes):
+    outputs = []
+    columns = "genbank_accession,country,date,pangolin_lineage"
+    for n in [1, processes]:
+        output_file = tmp_path / f"tfci.{n}.jsonl"
+        do_processing(os.path.join(TEST_DATA, "tfci.pb"),
+                      str(output_file),
+                      metadata_file=os.path.join(TEST_DATA,
+                                                 "tfci.meta.tsv.gz"),
+                      genbank_file=os.path.join(TEST_DATA, "hu1.gb"),
+                      columns=columns,
+                      processes=n)
+        outputs.append(output_file.read_bytes())
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("processes", [2, 4])
+def test_parallel_ids_match_serial(seed, processes):
+    positions = list(range(21563, 21575)) + list(range(13465, 13472))
+    data = random_tree_data(seed, 60, positions)
+    seq, _, codon_index = load_reference(os.path.join(TEST_DATA, "hu1.gb"))
+    serial = UsherMutationAnnotatedTree(data)
+    iterative_mutation_analysis(serial.tree, seq, lambda: None, codon_index,
+                                serial.mutation_table)
+    parallel = UsherMutationAnnotatedTree(data)
+    parallel_mutation_analysis(parallel.tree, seq, lambda: None, codon_index,
+                               parallel.mutation_table, processes)
+    # Mutations are interned in the same order, so the ids are the same too
+    assert parallel.mutation_table.mutations == serial.mutation_table.mutations
+    for node in serial.tree.preorder():
+        assert (parallel.tree.aa_mutation_ids[node] ==
+                serial.tree.aa_mutation_ids[node])